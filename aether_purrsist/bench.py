@@ -0,0 +1,393 @@
+"""
+Benchmarks of the sync stages, on a synthetic database (see synthdb.py)
+or on an existing one:
+
+    python -m aether_purrsist.bench --threads 500 --posts 30
+    python -m aether_purrsist.bench --db AetherDB.db --json bench.json
+
+IPFS is stubbed out: nothing is fetched, added or published. The time,
+throughput and peak RSS of every stage are reported.
+
+The startup time (the import time of the command's module, measured in a
+new interpreter with -X importtime) can be checked against a budget:
+
+    python -m aether_purrsist.bench --import-budget 300
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import aioipfs
+
+from . import mfs
+from . import purrsist
+from .database import db
+from .feeds import FeedSet
+from .identities import identities
+from .md import renderer as mdrenderer
+from .mfs import ArchiveUploader
+from .records import ThreadIndexEntry
+from .synthdb import generate
+
+
+STAGES = ['threads', 'indexes', 'feeds', 'sync']
+
+# Module imported by the aether-purrsist command
+ENTRYPOINT = 'aether_purrsist.entrypoint'
+
+
+class NullUploader(ArchiveUploader):
+    """
+    Uploader that doesn't upload anything
+    """
+
+    def __init__(self, client, rootp: Path, mfsp: str, **kw):
+        super().__init__(client, rootp, mfsp)
+
+    async def start(self) -> None:
+        pass
+
+    async def subtree(self, path: Path) -> None:
+        pass
+
+    async def finish(self) -> str:
+        return 'bafybench'
+
+
+class StubIPFS:
+    """
+    Stands in for the IPFS client: there's no previous archive, and
+    publishing does nothing
+    """
+
+    class Name:
+        def url(self, path: str) -> str:
+            return path
+
+        async def fetch_json(self, *args, **kw) -> dict:
+            return {'Name': 'bench'}
+
+    def __init__(self):
+        self.name = self.Name()
+
+    async def get(self, *args, **kw) -> None:
+        raise aioipfs.APIError(message='No archive')
+
+    async def close(self) -> None:
+        pass
+
+
+def peak_rss() -> int:
+    """
+    Peak RSS of this process and of the render workers, in bytes
+    """
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def import_time(module: Optional[str] = ENTRYPOINT) -> Dict[str, int]:
+    """
+    Import a module in a new interpreter with -X importtime. Returns the
+    cumulative import time (in microseconds) of every imported module
+    (only the interpreter's startup modules if module is None).
+    """
+    code = f'import {module}' if module else 'pass'
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times: Dict[str, int] = {}
+
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        name = fields[2].strip()
+        times[name] = max(times.get(name, 0), int(fields[1]))
+
+    return times
+
+
+def check_import_budget(budget_ms: float, top: int = 10) -> bool:
+    """
+    Print the import time of the command's module and the slowest
+    packages it imports (the interpreter's startup modules are left out),
+    returns False if it's over budget (in milliseconds)
+    """
+    startup = import_time(None)
+    times = import_time()
+    total = times.get(ENTRYPOINT, 0) / 1000
+    packages = sorted(
+        ((name, usecs) for name, usecs in times.items()
+         if '.' not in name and name not in startup),
+        key=lambda item: item[1], reverse=True)
+
+    print(f'Import time of {ENTRYPOINT}: {total:.1f} ms '
+          f'(budget: {budget_ms:g} ms)')
+
+    for name, usecs in packages[:top]:
+        print(f'    {name:24} {usecs / 1000:8.1f} ms')
+
+    return total <= budget_ms
+
+
+class Stage:
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.count: int = 0
+        self.seconds: float = 0
+        self.rss: int = 0
+
+    def __enter__(self) -> 'Stage':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.seconds = time.perf_counter() - self._start
+        self.rss = peak_rss()
+
+    @property
+    def throughput(self) -> float:
+        return self.count / self.seconds if self.seconds > 0 else 0
+
+    def report(self) -> dict:
+        return {
+            'stage': self.name,
+            'unit': self.unit,
+            'count': self.count,
+            'seconds': round(self.seconds, 4),
+            'throughput': round(self.throughput, 2),
+            'peak_rss': self.rss
+        }
+
+
+async def bench_threads(outp: Path, pretty: bool) -> Stage:
+    """
+    purrsist_thread() for every thread (load, render and write). As in
+    the sync, the scores are loaded once per page of threads.
+    """
+    with Stage('threads', 'threads') as stage:
+        for board in await db.boards():
+            async for batch in purrsist.board_threads(board.Fingerprint):
+                scores = await db.scores(
+                    board.Fingerprint,
+                    [thread.Fingerprint for thread in batch])
+
+                for thread in batch:
+                    threadp = outp.joinpath(board.Fingerprint,
+                                            thread.Fingerprint)
+                    purrsist.mkd(threadp)
+
+                    await purrsist.purrsist_thread(board, thread, threadp,
+                                                   scores, pretty=pretty)
+                    stage.count += 1
+
+    return stage
+
+
+async def bench_indexes(outp: Path) -> Stage:
+    """
+    board_threads_index() for every board (the queries are not timed)
+    """
+    stage = Stage('indexes', 'threads')
+
+    for board in await db.boards():
+        boardp = outp.joinpath(board.Fingerprint)
+        scores = await db.scores(board.Fingerprint)
+        threads = [ThreadIndexEntry(thread.Fingerprint, thread.Name,
+                                    scores.get(thread.Fingerprint, 0))
+                   for thread in await db.threads(board.Fingerprint)]
+
+        purrsist.mkd(boardp)
+        start = time.perf_counter()
+
+        await purrsist.board_threads_index(board, boardp, threads)
+
+        stage.seconds += time.perf_counter() - start
+        stage.count += len(threads)
+
+    stage.rss = peak_rss()
+    return stage
+
+
+async def bench_feeds(outp: Path, max_entries: int) -> Stage:
+    """
+    Atom and RSS feeds of all the threads, and of each board
+    """
+    now = datetime.now(timezone.utc)
+    purrsist.mkd(outp)
+
+    with Stage('feeds', 'entries') as stage:
+        with FeedSet(purrsist.feed_writers(outp, ['atom', 'rss'],
+                                           'Benchmark', now),
+                     max_entries=max_entries, ordered=False) as gfeed:
+            for board in await db.boards():
+                boardp = outp.joinpath(board.Fingerprint)
+                purrsist.mkd(boardp)
+
+                with FeedSet(purrsist.feed_writers(
+                        boardp, ['atom', 'rss'], board.Name, now,
+                        feed_id=purrsist.board_feed_id(board)),
+                        max_entries=max_entries) as bfeed:
+                    for thread in await db.threads(board.Fingerprint):
+                        fentry = purrsist.thread_feed_entry(board, thread)
+
+                        gfeed.add(fentry)
+                        bfeed.add(fentry)
+                        stage.count += 1
+
+    return stage
+
+
+async def bench_sync(outp: Path, pretty: bool, workers: int) -> Stage:
+    """
+    Whole sync of all the boards, with IPFS stubbed out
+    """
+    cfg = {
+        'ipfs': {'pinremote': {'enabled': False}},
+        'boards': {'.*': {}},
+        'render': {'workers': workers, 'pretty': pretty},
+        'feeds': {'atom_generate': True, 'rss_generate': True}
+    }
+    args = argparse.Namespace(full=True, car=None, render_only=False,
+                              verbose=0)
+    stage = Stage('sync', 'threads')
+
+    for board in await db.boards():
+        stage.count += len(await db.threads(board.Fingerprint))
+
+    uploader = mfs.TreeUploader
+    mfs.TreeUploader = NullUploader
+
+    try:
+        with stage:
+            await purrsist.purrsist(args, cfg, client=StubIPFS(), kid='bench',
+                                    workdir=outp)
+    finally:
+        mfs.TreeUploader = uploader
+
+    return stage
+
+
+async def run(args) -> List[Stage]:
+    tmpd = Path(tempfile.mkdtemp(prefix='aetherbench'))
+    dbpath: Optional[Path] = Path(args.db) if args.db else None
+
+    try:
+        if not dbpath:
+            dbpath = tmpd.joinpath('synth.db')
+            counts = await generate(
+                dbpath,
+                boards=args.boards,
+                threads=args.threads,
+                posts=args.posts,
+                depth=args.depth,
+                votes=args.votes,
+                markdown_ratio=args.markdown_ratio,
+                seed=args.seed
+            )
+            print('Generated: ' + ', '.join(
+                f'{count} {table}' for table, count in counts.items()))
+
+        await db.open(dbpath, raw=args.backend == 'sqlite')
+
+        stages = []
+
+        # Load the markdown extensions (imported on first use)
+        mdrenderer.convert('# Warm-up')
+
+        try:
+            for name in args.stages:
+                outp = tmpd.joinpath(name)
+
+                # Every stage starts with cold caches
+                identities.clear()
+                mdrenderer.clear()
+
+                if name == 'threads':
+                    stages.append(await bench_threads(outp, args.pretty))
+                elif name == 'indexes':
+                    stages.append(await bench_indexes(outp))
+                elif name == 'feeds':
+                    stages.append(await bench_feeds(outp, args.feeds_max))
+                elif name == 'sync':
+                    stages.append(await bench_sync(outp, args.pretty,
+                                                   args.workers))
+
+                shutil.rmtree(outp, ignore_errors=True)
+        finally:
+            await db.close()
+
+        return stages
+    finally:
+        shutil.rmtree(tmpd, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sync stages')
+    parser.add_argument('--db', default=None,
+                        help='Database to use (a synthetic database is '
+                             'generated otherwise)')
+    parser.add_argument('--backend', choices=['orm', 'sqlite'],
+                        default='orm')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=STAGES)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Render processes in the sync stage')
+    parser.add_argument('--no-pretty', dest='pretty', action='store_false',
+                        default=True)
+    parser.add_argument('--feeds-max', dest='feeds_max', type=int,
+                        default=500)
+    parser.add_argument('--json', dest='json', default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--import-budget', dest='import_budget', type=float,
+                        default=None, metavar='MS',
+                        help='Only check that the command starts (imports '
+                             'its modules) in less than MS milliseconds')
+
+    gen = parser.add_argument_group('synthetic database')
+    gen.add_argument('--boards', type=int, default=3)
+    gen.add_argument('--threads', type=int, default=100)
+    gen.add_argument('--posts', type=int, default=20)
+    gen.add_argument('--depth', type=int, default=4)
+    gen.add_argument('--votes', type=int, default=2)
+    gen.add_argument('--markdown-ratio', type=float, default=0.3,
+                     dest='markdown_ratio')
+    gen.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        sys.exit(0 if check_import_budget(args.import_budget) else 1)
+
+    stages = asyncio.run(run(args))
+
+    for stage in stages:
+        print(f'{stage.name:10} {stage.count:8} {stage.unit:8} '
+              f'{stage.seconds:9.3f}s {stage.throughput:10.1f} {stage.unit}/s'
+              f'  peak RSS {stage.rss / (1024 * 1024):.1f} MiB')
+
+    if args.json:
+        with open(args.json, 'wt') as fd:
+            json.dump([stage.report() for stage in stages], fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
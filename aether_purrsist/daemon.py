@@ -0,0 +1,156 @@
+import asyncio
+import re
+import shutil
+import signal
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from typing import Dict
+from typing import TYPE_CHECKING
+from typing import Optional
+
+from . import purrsist
+from .database import db
+from .identities import identities
+
+if TYPE_CHECKING:
+    import aioipfs
+
+
+INTERVAL_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400
+}
+
+
+def parse_interval(value: str) -> int:
+    """
+    Parse a duration like '90s', '15m', '2h' or '1d' (plain numbers are
+    seconds), returns the number of seconds
+    """
+    match = re.match(r'^\s*(\d+)\s*([smhd]?)\s*$', str(value))
+
+    if not match:
+        raise ValueError(f'Invalid interval: {value}')
+
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2) or 's']
+
+
+async def boards_marks(cfg: dict) -> Dict[str, tuple]:
+    """
+    Change marks (see Database.marks) of every selected board
+    """
+    return {
+        board.Fingerprint: await db.marks(
+            board_cfg.get('fingerprint', board.Fingerprint))
+        async for board, board_cfg in purrsist.boards_selection(cfg['boards'])
+    }
+
+
+class Daemon:
+    """
+    Runs the sync every interval seconds, as long as it's not stopped.
+
+    The database connection, the IPFS client, the caches and the archive's
+    files are kept between the syncs. Before each sync, the newest arrivals
+    of the selected boards are polled, and the archive is only regenerated
+    and published again if they have changed. The last published archive
+    is republished every republish seconds (0: never) if nothing changed.
+    """
+
+    def __init__(self, args, cfg: dict,
+                 interval: int,
+                 republish: int = 0):
+        self.args = args
+        self.cfg = cfg
+        self.interval = interval
+        self.republish = republish
+
+        self.client: Optional['aioipfs.AsyncIPFS'] = None
+        self.kid: Optional[str] = None
+        self.cid: Optional[str] = None
+        self.marks: Optional[Dict[str, tuple]] = None
+        self.published: float = 0
+
+        self._stop = asyncio.Event()
+
+    def stop(self) -> None:
+        """
+        Stop the daemon (a sync that's running is finished first)
+        """
+        self._stop.set()
+
+    async def wait(self, seconds: int) -> None:
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def sync(self, workdir: Path) -> None:
+        marks = await boards_marks(self.cfg)
+
+        if marks == self.marks:
+            if self.args.verbose > 0:
+                print('No changes')
+
+            if self.cid and self.republish > 0 and \
+                    time.monotonic() - self.published >= self.republish:
+                from .publish import ipns_publish
+
+                await ipns_publish(self.client, self.cid, self.kid,
+                                   self.cfg.get('ipfs', {}).get('publish', {}))
+                self.published = time.monotonic()
+
+            return
+
+        identities.forget_unknown()
+
+        cid = await purrsist.purrsist(
+            self.args, self.cfg,
+            client=self.client,
+            kid=self.kid,
+            prev=f'/ipfs/{self.cid}' if self.cid else None,
+            workdir=workdir
+        )
+
+        # --full only applies to the first sync
+        self.args.full = False
+        self.cid, self.marks = cid, marks
+        self.published = time.monotonic()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(signum, self.stop)
+
+        ipfscfg = self.cfg.get('ipfs', {})
+        workdir = Path(tempfile.mkdtemp(prefix='aetherp'))
+
+        import aioipfs
+
+        self.client = aioipfs.AsyncIPFS(
+            maddr=ipfscfg.get('maddr', '/dns4/localhost/tcp/5001')
+        )
+
+        try:
+            self.kid = await purrsist.ipns_key(
+                self.client, ipfscfg.get('ipns_key', 'aether'))
+
+            while not self._stop.is_set():
+                try:
+                    await self.sync(workdir)
+                except Exception:
+                    # Retried at the next interval
+                    traceback.print_exc()
+
+                await self.wait(self.interval)
+        finally:
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                loop.remove_signal_handler(signum)
+
+            await self.client.close()
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,396 @@
+import functools
+import sqlite3
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import aiosqlite
+
+from .metrics import metrics
+from .records import BoardRecord
+from .records import IdentityRecord
+from .records import PostRecord
+from .records import ThreadRecord
+
+
+# Indexes for the queries we run, built on database snapshots
+SNAPSHOT_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS purrsist_posts_thread '
+    'ON posts (Board, Thread, Parent)',
+    'CREATE INDEX IF NOT EXISTS purrsist_votes_target '
+    'ON votes (Board, TypeClass, Target, Type)',
+    'CREATE INDEX IF NOT EXISTS purrsist_votes_thread '
+    'ON votes (Board, Thread, LocalArrival)',
+    'CREATE INDEX IF NOT EXISTS purrsist_threads_board '
+    'ON threads (Board, LocalArrival)'
+]
+
+
+# Votes score of every voted object (thread or post) of a board
+SCORES_SQL = 'SELECT Target, ' \
+    'SUM(CASE Type WHEN 1 THEN 1 WHEN 2 THEN -1 ELSE 0 END) ' \
+    'FROM votes WHERE Board = ? AND TypeClass = 1 {threads}GROUP BY Target'
+
+# Maximum number of values in an IN (...) list (sqlite limits the number
+# of variables in a query)
+IN_MAX = 500
+
+
+# Page of the threads of a board, newest first, starting after a
+# (LocalArrival, Fingerprint) key (keyset pagination)
+THREADS_PAGE_SQL = 'SELECT Fingerprint, Owner, Name, Body, Link, ' \
+    'LocalArrival FROM threads WHERE Board = ? {after}' \
+    'ORDER BY LocalArrival DESC, Fingerprint LIMIT ?'
+
+THREADS_AFTER_SQL = 'AND (LocalArrival < ? OR ' \
+    '(LocalArrival = ? AND Fingerprint > ?)) '
+
+
+# Newest arrivals and updates of a board, used to detect changes
+MARKS_SQL = 'SELECT ' \
+    '(SELECT MAX(LocalArrival) FROM threads WHERE Board = ?), ' \
+    '(SELECT MAX(LocalArrival) FROM posts WHERE Board = ?), ' \
+    '(SELECT MAX(LastUpdate) FROM posts WHERE Board = ?), ' \
+    '(SELECT MAX(LocalArrival) FROM votes WHERE Board = ?)'
+
+
+def chunks(values: List[str], size: int = IN_MAX) -> Iterator[List[str]]:
+    for idx in range(0, len(values), size):
+        yield values[idx:idx + size]
+
+
+def marks(values: List[str]) -> str:
+    return ', '.join('?' for value in values)
+
+
+def query(model: str):
+    """
+    Count and time the calls of a query method, per model
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kw):
+            with metrics.timer('sql_query', model=model):
+                return await method(*args, **kw)
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot(path: Path, dstp: Path) -> None:
+    """
+    Copy the database at path to dstp with sqlite's online backup API
+    (a consistent copy, even if Aether is writing to the database), and
+    build the indexes used by our queries on the copy
+    """
+    src = sqlite3.connect(f'{path.absolute().as_uri()}?mode=ro', uri=True)
+    dst = sqlite3.connect(str(dstp))
+
+    try:
+        with dst:
+            src.backup(dst)
+
+        with dst:
+            for sql in SNAPSHOT_INDEXES:
+                dst.execute(sql)
+
+        dst.execute('ANALYZE')
+    finally:
+        src.close()
+        dst.close()
+
+
+def sql_datetime(value: Union[None, int, str]) -> Optional[datetime]:
+    """
+    Convert a timestamp column (unix time or ISO 8601 string) the same
+    way the ORM does
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, (int, float)):
+        date = datetime.fromtimestamp(value)
+    else:
+        date = datetime.fromisoformat(value)
+
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+
+    return date.astimezone(timezone.utc)
+
+
+class Database:
+    """
+    Read access to the Aether database. The rows are returned as
+    records (see records.py): only the records fields are selected, the
+    ORM models are never instantiated.
+
+    By default the Tortoise ORM models are used (tortoise is imported when
+    the database is opened, and the schema, which is Aether's, is never
+    generated). If the database is opened in raw mode, it's opened
+    read-only with sqlite (the ORM is not initialized, so nothing can be
+    written to the database), and only the columns that are needed are
+    selected. Unless immutable is False, sqlite
+    assumes that the database file is not modified while it's open.
+    """
+
+    def __init__(self):
+        self.conn: Optional[aiosqlite.Connection] = None
+
+    async def open(self, path: Path,
+                   raw: bool = False,
+                   mmap_size: int = 256 * 1024 * 1024,
+                   immutable: bool = True) -> None:
+        if raw:
+            self.conn = await aiosqlite.connect(
+                f'{path.absolute().as_uri()}?mode=ro' +
+                ('&immutable=1' if immutable else ''),
+                uri=True
+            )
+            await self.conn.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+            await self.conn.execute('PRAGMA query_only=1')
+        else:
+            # The ORM is only imported when it's used. The schema is
+            # Aether's: it's never generated here.
+            from tortoise import Tortoise
+
+            await Tortoise.init(
+                db_url=f'sqlite://{path}',
+                modules={'models': ['aether_purrsist.models']}
+            )
+
+    async def close(self) -> None:
+        if self.conn:
+            await self.conn.close()
+            self.conn = None
+        else:
+            from tortoise import Tortoise
+
+            await Tortoise.close_connections()
+
+    async def fetch(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        async with self.conn.execute(sql, tuple(params)) as cursor:
+            return await cursor.fetchall()
+
+    async def execute(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        """
+        Run an SQL query in both modes (with the ORM's connection if the
+        database is not opened in raw mode). The values are not converted.
+        """
+        if self.conn:
+            return await self.fetch(sql, params)
+
+        from tortoise import Tortoise
+
+        _, rows = await Tortoise.get_connection('default').execute_query(
+            sql, list(params))
+
+        return [tuple(row) for row in rows]
+
+    @query('boards')
+    async def boards(self) -> List[BoardRecord]:
+        if self.conn:
+            return [BoardRecord(*row) for row in await self.fetch(
+                'SELECT Fingerprint, Name, Owner FROM boards '
+                'ORDER BY Name, Fingerprint'
+            )]
+
+        from .models import Boards
+
+        return [BoardRecord(*row) for row in await Boards.all().order_by(
+            'Name', 'Fingerprint').values_list(*BoardRecord._fields)]
+
+    @query('threads')
+    async def threads(self, board_fp: str) -> List[ThreadRecord]:
+        """
+        Threads of a board, newest first
+        """
+        if self.conn:
+            return [
+                ThreadRecord(fp, owner, name, body, link,
+                             sql_datetime(arrival))
+                for fp, owner, name, body, link, arrival in await self.fetch(
+                    'SELECT Fingerprint, Owner, Name, Body, Link, '
+                    'LocalArrival FROM threads WHERE Board = ? '
+                    'ORDER BY LocalArrival DESC, Fingerprint', (board_fp, ))
+            ]
+
+        from .models import Threads
+
+        return [ThreadRecord(*row) for row in await Threads.filter(
+            Board=board_fp
+        ).order_by('-LocalArrival', 'Fingerprint').values_list(
+            *ThreadRecord._fields)]
+
+    @query('threads')
+    async def threads_page(self, board_fp: str,
+                           limit: int,
+                           after: Optional[tuple] = None
+                           ) -> Tuple[List[ThreadRecord], Optional[tuple]]:
+        """
+        Page of at most limit threads of a board, newest first, after the
+        key returned with the previous page (or from the newest thread).
+        Returns the threads and the key of the last one.
+
+        The keys are the (LocalArrival, Fingerprint) values as they're
+        stored: the pages are read with the same SQL in both modes.
+        """
+        params = [board_fp]
+
+        if after:
+            arrival, fp = after
+            params += [arrival, arrival, fp]
+
+        rows = await self.execute(THREADS_PAGE_SQL.format(
+            after=THREADS_AFTER_SQL if after else ''), params + [limit])
+
+        return [
+            ThreadRecord(fp, owner, name, body, link, sql_datetime(arrival))
+            for fp, owner, name, body, link, arrival in rows
+        ], (rows[-1][5], rows[-1][0]) if rows else None
+
+    @query('posts')
+    async def posts(self, board_fp: str, thread_fp: str) -> List[PostRecord]:
+        """
+        Posts of a thread, oldest first (ordered by Creation, then
+        Fingerprint, so that the order is stable)
+        """
+        if self.conn:
+            return [
+                PostRecord(fp, owner, parent, body, sql_datetime(arrival))
+                for fp, owner, parent, body, arrival in await self.fetch(
+                    'SELECT Fingerprint, Owner, Parent, Body, LocalArrival '
+                    'FROM posts WHERE Board = ? AND Thread = ? '
+                    'ORDER BY Creation, Fingerprint',
+                    (board_fp, thread_fp))
+            ]
+
+        from .models import Posts
+
+        return [PostRecord(*row) for row in await Posts.filter(
+            Board=board_fp,
+            Thread=thread_fp
+        ).order_by('Creation', 'Fingerprint').values_list(
+            *PostRecord._fields)]
+
+    @query('votes')
+    async def scores(self, board_fp: str,
+                     thread_fps: Optional[List[str]] = None
+                     ) -> Dict[str, int]:
+        """
+        Votes score of every voted thread or post of a board (only of
+        these threads and their posts if thread_fps is set), with one
+        aggregate query (upvotes count 1, downvotes -1)
+        """
+        # The ORM can't aggregate a CASE expression
+        if thread_fps is None:
+            rows = await self.execute(SCORES_SQL.format(threads=''),
+                                      (board_fp, ))
+        else:
+            rows = []
+
+            for fps in chunks(thread_fps):
+                rows += await self.execute(SCORES_SQL.format(
+                    threads=f'AND Thread IN ({marks(fps)}) '),
+                    [board_fp] + fps)
+
+        return {target: score for target, score in rows}
+
+    @query('all')
+    async def marks(self, board_fp: str) -> tuple:
+        """
+        Newest thread arrival, post arrival and update, and vote arrival
+        of a board. If they're the same as in a previous call, nothing has
+        changed in the board since.
+        """
+        rows = await self.execute(MARKS_SQL, [board_fp] * 4)
+
+        return rows[0]
+
+    @query('publickeys')
+    async def identities(self, fingerprints: List[str]
+                         ) -> List[IdentityRecord]:
+        if self.conn:
+            return [IdentityRecord(*row) for row in await self.fetch(
+                'SELECT Fingerprint, Name FROM publickeys '
+                f'WHERE Fingerprint IN ({marks(fingerprints)})',
+                fingerprints)]
+
+        from .models import PublicKeys
+
+        return [IdentityRecord(*row) for row in await PublicKeys.filter(
+            Fingerprint__in=fingerprints).values_list(*IdentityRecord._fields)]
+
+    @query('posts')
+    async def posts_state(self, board_fp: str, thread_fps: List[str]
+                          ) -> List[Tuple[str, datetime, int, int]]:
+        """
+        (thread, newest arrival, newest update, count) of the posts of
+        these threads of a board, per thread
+        """
+        if self.conn:
+            return [(fp, sql_datetime(arrival), update, count)
+                    for fps in chunks(thread_fps)
+                    for fp, arrival, update, count in await self.fetch(
+                        'SELECT Thread, MAX(LocalArrival), MAX(LastUpdate), '
+                        'COUNT(Fingerprint) FROM posts WHERE Board = ? '
+                        f'AND Thread IN ({marks(fps)}) GROUP BY Thread',
+                        [board_fp] + fps)]
+
+        from tortoise.functions import Count
+        from tortoise.functions import Max
+
+        from .models import Posts
+
+        return [row for fps in chunks(thread_fps)
+                for row in await Posts.filter(
+                    Board=board_fp,
+                    Thread__in=fps
+                ).annotate(
+                    parrival=Max('LocalArrival'),
+                    pupdate=Max('LastUpdate'),
+                    pcount=Count('Fingerprint')
+                ).group_by('Thread').values_list(
+                    'Thread', 'parrival', 'pupdate', 'pcount')]
+
+    @query('votes')
+    async def votes_state(self, board_fp: str, thread_fps: List[str]
+                          ) -> List[Tuple[str, datetime, int]]:
+        """
+        (thread, newest arrival, count) of the votes of these threads of
+        a board, per thread
+        """
+        if self.conn:
+            return [(fp, sql_datetime(arrival), count)
+                    for fps in chunks(thread_fps)
+                    for fp, arrival, count in await self.fetch(
+                        'SELECT Thread, MAX(LocalArrival), '
+                        'COUNT(Fingerprint) FROM votes WHERE Board = ? '
+                        f'AND Thread IN ({marks(fps)}) GROUP BY Thread',
+                        [board_fp] + fps)]
+
+        from tortoise.functions import Count
+        from tortoise.functions import Max
+
+        from .models import Votes
+
+        return [row for fps in chunks(thread_fps)
+                for row in await Votes.filter(
+                    Board=board_fp,
+                    Thread__in=fps
+                ).annotate(
+                    varrival=Max('LocalArrival'),
+                    vcount=Count('Fingerprint')
+                ).group_by('Thread').values_list(
+                    'Thread', 'varrival', 'vcount')]
+
+
+db = Database()
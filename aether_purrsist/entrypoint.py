@@ -1,5 +1,7 @@
 import argparse
+import asyncio
 import os
+import tempfile
 from pathlib import Path
 
 import yaml
@@ -10,9 +12,12 @@ except ImportError:
     from yaml import Loader
 
 
-from tortoise import Tortoise, run_async
-
 from . import purrsist
+from .daemon import Daemon
+from .daemon import parse_interval
+from .database import db
+from .database import snapshot
+from .profiling import profiler
 
 
 async def init():
@@ -31,11 +36,84 @@ async def init():
         action='count',
         default=0
     )
+    parser.add_argument(
+        '--full',
+        dest='full',
+        action='store_true',
+        default=False,
+        help='Regenerate all the threads, even if they have not changed'
+    )
+    parser.add_argument(
+        '--car',
+        dest='car',
+        default=None,
+        metavar='PATH',
+        help='Write the archive to a CAR file, without an IPFS node'
+    )
+    parser.add_argument(
+        '--snapshot',
+        dest='snapshot',
+        action='store_true',
+        default=False,
+        help='Work on an indexed snapshot of the Aether database'
+    )
+    parser.add_argument(
+        '--daemon',
+        dest='daemon',
+        action='store_true',
+        default=False,
+        help='Run continuously, syncing when the database changes'
+    )
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        default='15m',
+        help='Database polling interval in daemon mode (e.g: 90s, 15m, 1h)'
+    )
+    parser.add_argument(
+        '--render-only',
+        dest='render_only',
+        action='store_true',
+        default=False,
+        help='Only render the archive, without using IPFS'
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        nargs='?',
+        const='purrsist-profile',
+        default=None,
+        metavar='DIR',
+        help='Profile the sync with cProfile, a .prof file is written '
+             'for each stage in DIR (default: purrsist-profile)'
+    )
+    parser.add_argument(
+        '--trace-memory',
+        dest='trace_memory',
+        action='store_true',
+        default=False,
+        help='Trace the memory allocations, the top allocators are '
+             'printed after each board'
+    )
     args = parser.parse_args()
 
+    if args.daemon and (args.car or args.snapshot or args.render_only):
+        parser.error('--daemon cannot be used with --car, --snapshot '
+                     'or --render-only')
+    elif args.car and args.render_only:
+        parser.error('--car cannot be used with --render-only')
+
+    try:
+        interval = parse_interval(args.interval)
+    except ValueError as err:
+        parser.error(str(err))
+
     with open(args.config, 'rt') as fd:
         cfg = yaml.load(fd, Loader=Loader)
 
+    profiler.configure(outdir=Path(args.profile) if args.profile else None,
+                       trace_memory=args.trace_memory)
+
     home = Path(os.getenv('HOME'))
     aethcfgp = home.joinpath('.config').joinpath(
         'Air Labs').joinpath('Aether')
@@ -48,14 +126,39 @@ async def init():
     if not dbpath.is_file():
         raise ValueError(f'DB file {dbpath} does not exist')
 
-    await Tortoise.init(
-        db_url=f'sqlite://{dbpath}',
-        modules={'models': ['aether_purrsist.models']}
-    )
-    await Tortoise.generate_schemas()
+    snapp = None
+
+    if args.snapshot:
+        fd, name = tempfile.mkstemp(prefix='aetherdb', suffix='.db')
+        os.close(fd)
+
+        snapp = Path(name)
+        snapshot(dbpath, snapp)
+        dbpath = snapp
+
+    try:
+        await db.open(dbpath,
+                      raw=cfg.get('db_backend', 'orm') == 'sqlite',
+                      mmap_size=cfg.get('db_mmap_size', 256 * 1024 * 1024),
+                      immutable=not args.daemon)
+
+        try:
+            if args.daemon:
+                daemoncfg = cfg.get('daemon', {})
 
-    await purrsist.purrsist(args, cfg)
+                await Daemon(
+                    args, cfg, interval,
+                    republish=parse_interval(
+                        daemoncfg.get('republish_interval', 0))
+                ).run()
+            else:
+                await purrsist.purrsist(args, cfg)
+        finally:
+            await db.close()
+    finally:
+        if snapp:
+            snapp.unlink()
 
 
 def start():
-    run_async(init())
+    asyncio.run(init())
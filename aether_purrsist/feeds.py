@@ -0,0 +1,229 @@
+import heapq
+import itertools
+from datetime import datetime
+from email.utils import format_datetime
+from pathlib import Path
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from xml.sax.saxutils import XMLGenerator
+
+from .output import output
+
+
+PURRSIST_URL = 'https://gitlab.com/galacteek/aether-purrsist'
+
+
+class FeedEntry(NamedTuple):
+    id: str
+    title: str
+    link: str
+    published: datetime
+    content: str
+    html: bool = False
+    source: Optional[str] = None
+
+
+class FeedWriter:
+    """
+    Streaming Atom or RSS feed writer.
+
+    The entries are written to the feed's file as they are added,
+    so they're never all held in memory.
+    """
+
+    def __init__(self, path: Path, fmt: str,
+                 title: str, description: str,
+                 updated: datetime,
+                 link: str = '.',
+                 feed_id: str = PURRSIST_URL):
+        assert fmt in ['atom', 'rss']
+
+        self.path = path
+        self.fmt = fmt
+        self.title = title
+        self.description = description
+        self.updated = updated
+        self.link = link
+        self.feed_id = feed_id
+        self.count: int = 0
+
+        self._fd = None
+        self._xml: Optional[XMLGenerator] = None
+
+    def __enter__(self) -> 'FeedWriter':
+        self.open()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _element(self, name: str, text: Optional[str] = None,
+                 attrs: dict = {}) -> None:
+        self._xml.startElement(name, attrs)
+
+        if text:
+            self._xml.characters(text)
+
+        self._xml.endElement(name)
+
+    def open(self) -> None:
+        self._fd = output.open(self.path)
+        self._xml = XMLGenerator(self._fd, encoding='utf-8',
+                                 short_empty_elements=True)
+        self._xml.startDocument()
+
+        if self.fmt == 'atom':
+            self._xml.startElement('feed', {
+                'xmlns': 'http://www.w3.org/2005/Atom',
+                'xml:lang': 'en'
+            })
+            self._element('id', self.feed_id)
+            self._element('title', self.title)
+            self._element('updated', self.updated.isoformat())
+            self._element('link', attrs={'href': self.link})
+            self._element('generator', 'aether-purrsist', {
+                'uri': PURRSIST_URL
+            })
+            self._element('subtitle', self.description)
+        else:
+            self._xml.startElement('rss', {'version': '2.0'})
+            self._xml.startElement('channel', {})
+            self._element('title', self.title)
+            self._element('link', self.link)
+            self._element('description', self.description)
+            self._element('generator', 'aether-purrsist')
+            self._element('language', 'en')
+            self._element('lastBuildDate', format_datetime(self.updated))
+            self._element('pubDate', format_datetime(self.updated))
+
+        self._xml.ignorableWhitespace('\n')
+
+    def add(self, entry: FeedEntry) -> None:
+        if self.fmt == 'atom':
+            self._xml.startElement('entry', {})
+            self._element('id', entry.id)
+            self._element('title', entry.title)
+            self._element('updated', entry.published.isoformat())
+            self._element('content', entry.content,
+                          {'type': 'html'} if entry.html else {})
+            self._element('link', attrs={'href': entry.link})
+            self._element('published', entry.published.isoformat())
+
+            if entry.source:
+                self._element('link', attrs={
+                    'rel': 'via',
+                    'href': entry.source
+                })
+
+            self._xml.endElement('entry')
+        else:
+            self._xml.startElement('item', {})
+            self._element('title', entry.title)
+            self._element('link', entry.link)
+            self._element('description', entry.content)
+            self._element('guid', entry.id, {'isPermaLink': 'false'})
+            self._element('pubDate', format_datetime(entry.published))
+
+            if entry.source:
+                self._element('source', entry.source,
+                              {'url': entry.source})
+
+            self._xml.endElement('item')
+
+        self._xml.ignorableWhitespace('\n')
+        self.count += 1
+
+    def close(self) -> None:
+        if not self._fd:
+            return
+
+        if self.fmt == 'atom':
+            self._xml.endElement('feed')
+        else:
+            self._xml.endElement('channel')
+            self._xml.endElement('rss')
+
+        self._xml.endDocument()
+        self._fd.close()
+        self._fd = self._xml = None
+
+
+class FeedSet:
+    """
+    A feed written in one or several formats, with at most max_entries
+    entries (0: no limit).
+
+    If ordered is True, the entries are added newest first and are written
+    right away. Otherwise only the newest max_entries entries are kept
+    (in a bounded heap) and they're written when the feed is closed.
+    """
+
+    def __init__(self, writers: List[FeedWriter],
+                 max_entries: int = 0,
+                 ordered: bool = True):
+        self.writers = writers
+        self.max_entries = max_entries
+        self.ordered = ordered
+
+        self._heap: list = []
+        self._seq = itertools.count()
+
+    def __enter__(self) -> 'FeedSet':
+        self.open()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def full(self) -> bool:
+        if self.max_entries <= 0:
+            return False
+
+        if self.ordered:
+            return self.writers[0].count >= self.max_entries \
+                if self.writers else True
+        else:
+            return len(self._heap) >= self.max_entries
+
+    def wants(self, published: datetime) -> bool:
+        """
+        Returns True if an entry published at this date would be added
+        """
+        if not self.writers:
+            return False
+
+        if not self.full:
+            return True
+
+        return not self.ordered and published > self._heap[0][0]
+
+    def add(self, entry: FeedEntry) -> None:
+        if not self.wants(entry.published):
+            return
+
+        if self.ordered or self.max_entries <= 0:
+            for writer in self.writers:
+                writer.add(entry)
+        else:
+            item = (entry.published, next(self._seq), entry)
+
+            if self.full:
+                heapq.heapreplace(self._heap, item)
+            else:
+                heapq.heappush(self._heap, item)
+
+    def open(self) -> None:
+        for writer in self.writers:
+            writer.open()
+
+    def close(self) -> None:
+        for published, seq, fentry in sorted(self._heap, reverse=True):
+            for writer in self.writers:
+                writer.add(fentry)
+
+        self._heap = []
+
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from .database import chunks
+from .database import db
+from .records import IdentityRecord
+
+
+_missing = object()
+
+
+class IdentityCache:
+    """
+    Bounded LRU cache of the identities (PublicKeys rows), indexed
+    by fingerprint.
+
+    Unknown fingerprints are cached too (as None), so that a user
+    whose key is not in the database is only looked up once.
+    The hits/misses counters account for get() calls and for the
+    fingerprints passed to preload().
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self._keys: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, fingerprint: str) -> bool:
+        return fingerprint in self._keys
+
+    def _store(self, fingerprint: str, key: Optional[IdentityRecord]) -> None:
+        self._keys[fingerprint] = key
+        self._keys.move_to_end(fingerprint)
+
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+    def clear(self, stats: bool = True) -> None:
+        self._keys.clear()
+
+        if stats:
+            self.hits = self.misses = 0
+
+    def forget_unknown(self) -> None:
+        """
+        Drop the unknown fingerprints, their keys may have been received
+        since they were looked up
+        """
+        for fp in [fp for fp, key in self._keys.items() if key is None]:
+            del self._keys[fp]
+
+    async def preload(self, fingerprints: Iterable[str]
+                      ) -> Dict[str, Optional[IdentityRecord]]:
+        """
+        Load the keys for the given fingerprints that are not cached yet
+        (each one counts as a miss), with a single query. Returns the keys
+        of all the given fingerprints.
+        """
+        keys: Dict[str, Optional[IdentityRecord]] = {}
+        wanted: List[str] = []
+
+        for fp in set(fingerprints):
+            key = self._keys.get(fp, _missing)
+
+            if key is _missing:
+                wanted.append(fp)
+            else:
+                self._keys.move_to_end(fp)
+                keys[fp] = key
+
+        self.hits += len(keys)
+        self.misses += len(wanted)
+
+        # Stay below SQLite's host parameters limit
+        for chunk in chunks(wanted):
+            keys.update(dict.fromkeys(chunk))
+
+            for key in await db.identities(chunk):
+                keys[key.Fingerprint] = key
+
+            for fp in chunk:
+                self._store(fp, keys[fp])
+
+        return keys
+
+    async def get(self, fingerprint: str) -> Optional[IdentityRecord]:
+        key = self._keys.get(fingerprint, _missing)
+
+        if key is not _missing:
+            self.hits += 1
+            self._keys.move_to_end(fingerprint)
+            return key
+
+        self.misses += 1
+
+        keys = await db.identities([fingerprint])
+        key = keys[0] if keys else None
+
+        self._store(fingerprint, key)
+        return key
+
+
+identities = IdentityCache()
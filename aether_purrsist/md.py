@@ -1,4 +1,9 @@
+import hashlib
 import re
+from collections import OrderedDict
+from typing import Optional
+
+from .metrics import metrics
 
 # Some of those regexps are from LLazyEmail/markdown-regex
 
@@ -17,11 +22,84 @@ regexp_CODE_B = re.compile(r'```(.*)```', re.MULTILINE)
 regexp_CODE_S = re.compile(r'`(.*?)`', re.MULTILINE)
 
 
+# All the markdown detection regexps, combined in one pattern so that
+# the text is only scanned once
+regexp_MD = re.compile('|'.join(f'(?:{reg.pattern})' for reg in [
+    regexp_H,
+    regexp_H_U,
+    regexp_IMAGE,
+    regexp_STRONG,
+    regexp_CODE_B,
+    regexp_CODE_S,
+    regexp_LINK
+]), re.MULTILINE)
+
+
 def is_markdown(text: str) -> bool:
-    return any(reg.search(text) for reg in [regexp_H,
-                                            regexp_H_U,
-                                            regexp_IMAGE,
-                                            regexp_STRONG,
-                                            regexp_CODE_B,
-                                            regexp_CODE_S,
-                                            regexp_LINK])
+    return regexp_MD.search(text) is not None
+
+
+class MarkdownRenderer:
+    """
+    Converts markdown texts to HTML with a reusable Markdown instance.
+
+    The results (the HTML, or None if the text is not markdown) are kept
+    in a LRU cache, indexed by the hash of the text. The markdown module
+    and its extensions are loaded on the first conversion.
+    """
+
+    def __init__(self, extensions: list = [], maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self.extensions = extensions
+
+        self._md = None
+        self._cache: OrderedDict = OrderedDict()
+
+    def convert(self, text: str) -> str:
+        with metrics.timer('markdown'):
+            if self._md is None:
+                import markdown
+
+                self._md = markdown.Markdown(extensions=self.extensions)
+
+            return self._md.reset().convert(text)
+
+    def clear(self, stats: bool = True) -> None:
+        self._cache.clear()
+
+        if stats:
+            self.hits = self.misses = 0
+
+    def html(self, text: str) -> Optional[str]:
+        """
+        Returns the HTML for a markdown text, or None if the text
+        is not markdown
+        """
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+        try:
+            html = self._cache[key]
+        except KeyError:
+            self.misses += 1
+
+            html = self.convert(text) if is_markdown(text) else None
+
+            self._cache[key] = html
+
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+
+        return html
+
+
+# Renderer shared by the threads pages and the feeds
+renderer = MarkdownRenderer(extensions=[
+    'attr_list',
+    'fenced_code'
+])
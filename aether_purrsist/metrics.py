@@ -0,0 +1,203 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+# (metric name, sorted labels)
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics:
+    """
+    Counters and timers of a sync run.
+
+    Timers record the number of calls and the total time. The labels set
+    with labels() are added to everything that's recorded in the block
+    (this is how the rendering is accounted to boards).
+
+    The render workers record their metrics in their own process: they're
+    sent back with each result (see collected()) and merged.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Key, float] = defaultdict(float)
+        self.timers: Dict[Key, List[float]] = defaultdict(lambda: [0, 0.0])
+        self.started: float = time.time()
+
+        self._labels: Dict[str, str] = {}
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.timers.clear()
+        self.started = time.time()
+
+    def _key(self, name: str, labels: dict) -> Key:
+        return (name, tuple(sorted(
+            (lname, str(value))
+            for lname, value in dict(self._labels, **labels).items()
+        )))
+
+    def add(self, name: str, value: float = 1, **labels) -> None:
+        self.counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        timer = self.timers[self._key(name, labels)]
+        timer[0] += 1
+        timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def labels(self, **labels) -> Iterator[None]:
+        prev = self._labels
+        self._labels = dict(prev, **labels)
+
+        try:
+            yield
+        finally:
+            self._labels = prev
+
+    def drain(self) -> tuple:
+        """
+        Returns the recorded metrics (as plain tuples), and forgets them
+        """
+        snapshot = (dict(self.counters),
+                    {key: tuple(timer) for key, timer in self.timers.items()})
+        self.counters.clear()
+        self.timers.clear()
+        return snapshot
+
+    def merge(self, snapshot: tuple) -> None:
+        counters, timers = snapshot
+
+        for key, value in counters.items():
+            self.counters[key] += value
+
+        for key, (count, seconds) in timers.items():
+            self.timers[key][0] += count
+            self.timers[key][1] += seconds
+
+    def report(self, **fields) -> dict:
+        """
+        Run report, with fields added at the top level
+        """
+        return dict(
+            fields,
+            started=datetime.fromtimestamp(
+                self.started, timezone.utc).isoformat(),
+            duration=round(time.time() - self.started, 3),
+            counters=[
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            timers=[
+                {'name': name, 'labels': dict(labels), 'count': count,
+                 'seconds': round(seconds, 6)}
+                for (name, labels), (count, seconds) in sorted(
+                    self.timers.items())
+            ]
+        )
+
+    def textfile(self, prefix: str = 'purrsist') -> str:
+        """
+        The metrics in the Prometheus text format, for node_exporter's
+        textfile collector
+        """
+        def number(value: float) -> str:
+            # Exact values (the counters are floats)
+            if float(value).is_integer():
+                return str(int(value))
+
+            return repr(float(value))
+
+        def labelstr(labels) -> str:
+            if not labels:
+                return ''
+
+            return '{' + ','.join(
+                '{0}="{1}"'.format(name, value.replace('\\', '\\\\').replace(
+                    '"', '\\"').replace('\n', '\\n'))
+                for name, value in labels
+            ) + '}'
+
+        lines = [
+            f'# TYPE {prefix}_run_timestamp_seconds gauge',
+            f'{prefix}_run_timestamp_seconds {self.started:.3f}',
+            f'# TYPE {prefix}_run_duration_seconds gauge',
+            f'{prefix}_run_duration_seconds '
+            f'{time.time() - self.started:.3f}'
+        ]
+
+        for name in sorted(set(key[0] for key in self.counters)):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines += [f'{prefix}_{name}_total{labelstr(labels)} '
+                      f'{number(value)}'
+                      for (cname, labels), value in sorted(
+                          self.counters.items()) if cname == name]
+
+        for name in sorted(set(key[0] for key in self.timers)):
+            lines.append(f'# TYPE {prefix}_{name}_seconds summary')
+
+            for (tname, labels), (count, seconds) in sorted(
+                    self.timers.items()):
+                if tname == name:
+                    lines += [
+                        f'{prefix}_{name}_seconds_sum{labelstr(labels)} '
+                        f'{seconds:.6f}',
+                        f'{prefix}_{name}_seconds_count{labelstr(labels)} '
+                        f'{count}'
+                    ]
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path: Optional[str] = None,
+              textfile_path: Optional[str] = None,
+              **fields) -> None:
+        """
+        Write the JSON report and/or the Prometheus textfile. The files
+        are replaced atomically.
+        """
+        for path, content in [
+            (json_path, lambda: json.dumps(self.report(**fields), indent=2)),
+            (textfile_path, self.textfile)
+        ]:
+            if not path:
+                continue
+
+            tmpp = Path(f'{path}.tmp')
+            tmpp.write_text(content())
+            os.replace(tmpp, path)
+
+
+def collected(fn: Callable, labels: dict, *args) -> tuple:
+    """
+    Call fn (in a worker process) with the given labels. Returns the
+    result, and the metrics recorded during the call.
+    """
+    metrics.drain()
+
+    with metrics.labels(**labels):
+        result = fn(*args)
+
+    return result, metrics.drain()
+
+
+metrics = Metrics()
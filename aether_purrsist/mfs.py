@@ -0,0 +1,457 @@
+import asyncio
+from abc import ABC
+from abc import abstractmethod
+from pathlib import Path
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+import aiofiles
+import aioipfs
+from aiohttp import MultipartWriter
+from aiohttp import payload
+
+from .output import output
+from .unixfs import CarWriter
+from .unixfs import DagBuilder
+from .unixfs import DagNode
+from .unixfs import DEFAULT_CHUNK_SIZE
+from .unixfs import cid_str
+
+
+ADD_CHUNK_SIZE = 256 * 1024
+
+
+async def mfs_resolve(client: aioipfs.AsyncIPFS,
+                      ipnsp: str) -> Optional[str]:
+    """
+    Resolve the IPFS path of the previous archive published on an IPNS
+    path. Returns None if it can't be resolved.
+    """
+    try:
+        resp = await client.name.resolve(ipnsp)
+        return resp['Path']
+    except (aioipfs.APIError, KeyError):
+        return None
+
+
+async def file_chunks(path: Path,
+                      size: int = ADD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    async with aiofiles.open(str(path), 'rb') as fd:
+        while True:
+            data = await fd.read(size)
+            if not data:
+                break
+
+            yield data
+
+
+def tree_multipart(path: Path) -> MultipartWriter:
+    """
+    Build the multipart form to add a directory (recursively, including the
+    dot files). The files are only opened and read while the form is being
+    sent, one at a time.
+    """
+    mpwriter = MultipartWriter('form-data')
+
+    for fpath in [path] + sorted(path.rglob('*')):
+        name = fpath.relative_to(path.parent).as_posix()
+
+        if fpath.is_dir():
+            part = payload.StringPayload(
+                '', content_type='application/x-directory')
+        elif fpath.is_file():
+            part = payload.AsyncIterablePayload(
+                file_chunks(fpath),
+                content_type='application/octet-stream',
+                headers={'Abspath': str(fpath.absolute())}
+            )
+        else:
+            continue
+
+        part.set_content_disposition('form-data', name='file', filename=name)
+        mpwriter.append_payload(part)
+
+    return mpwriter
+
+
+def memory_multipart(path: Path,
+                     files: Dict[Path, bytes]) -> MultipartWriter:
+    """
+    Build the multipart form to add a directory from files held in memory
+    (files: path -> contents, for files under path)
+    """
+    mpwriter = MultipartWriter('form-data')
+    dirs = set([path])
+
+    for fpath in files:
+        dirs.update(parent for parent in fpath.parents
+                    if path in parent.parents)
+
+    # The directories are declared before their contents
+    for fpath in sorted(dirs | set(files)):
+        name = fpath.relative_to(path.parent).as_posix()
+
+        if fpath in dirs:
+            part = payload.StringPayload(
+                '', content_type='application/x-directory')
+        else:
+            part = payload.BytesPayload(
+                files[fpath], content_type='application/octet-stream')
+
+        part.set_content_disposition('form-data', name='file', filename=name)
+        mpwriter.append_payload(part)
+
+    return mpwriter
+
+
+def add_params(chunker: Optional[str] = None,
+               raw_leaves: bool = True,
+               nocopy: bool = False,
+               only_hash: bool = False) -> dict:
+    params = {
+        'cid-version': '1',
+        'raw-leaves': 'true' if raw_leaves or nocopy else 'false',
+        'nocopy': 'true' if nocopy else 'false',
+        'only-hash': 'true' if only_hash else 'false'
+    }
+
+    if chunker:
+        params['chunker'] = chunker
+
+    return params
+
+
+async def add_form(client: aioipfs.AsyncIPFS,
+                   form: MultipartWriter,
+                   params: dict) -> AsyncIterator[dict]:
+    async for entry in client.core.mjson_decode(
+            client.core.url('add'),
+            method='post',
+            data=form,
+            params=params):
+        yield entry
+
+
+async def add_tree(client: aioipfs.AsyncIPFS,
+                   path: Path,
+                   **opts) -> AsyncIterator[dict]:
+    """
+    Add a directory to IPFS, yielding the entry of every file and directory
+    as soon as it's been added. The directory's entry comes last.
+    opts are the add options (see add_params()).
+    """
+    async for entry in add_form(client, tree_multipart(path),
+                                add_params(**opts)):
+        yield entry
+
+
+class ArchiveUploader(ABC):
+    """
+    Uploads the archive's tree (rootp) to IPFS while it's being generated.
+
+    subtree() is called with each directory of the archive that is complete
+    (a board's directory), and finish() uploads the rest of the tree.
+    The root of the archive is assembled in MFS, at the mfsp path.
+    """
+
+    def __init__(self, client: aioipfs.AsyncIPFS, rootp: Path, mfsp: str):
+        self.client = client
+        self.rootp = rootp
+        self.mfsp = mfsp
+
+    def mfs_path(self, path: Path) -> str:
+        return f'{self.mfsp}/{path.relative_to(self.rootp).as_posix()}'
+
+    async def mfs_rm(self, mfsp: str) -> None:
+        try:
+            await self.client.files.rm(mfsp, recursive=True)
+        except aioipfs.APIError:
+            # Does not exist
+            pass
+
+    async def mfs_reset(self) -> None:
+        await self.mfs_rm(self.mfsp)
+
+    async def write_file(self, path: Path) -> None:
+        # The contents are passed (aioipfs can't stream a file with recent
+        # aiohttp versions). Errors are returned as None by aioipfs.
+        result = await self.client.files.write(
+            self.mfs_path(path),
+            path.read_bytes(),
+            create=True,
+            parents=True,
+            truncate=True,
+            cid_version=1,
+            raw_leaves=True
+        )
+
+        if result is None:
+            raise aioipfs.APIError(message=f'{path}: MFS write failed')
+
+    async def root_cid(self) -> str:
+        await self.client.files.flush(self.mfsp)
+
+        stat = await self.client.files.stat(self.mfsp, hash=True)
+        return stat['Hash']
+
+    async def start(self) -> None:
+        pass
+
+    @abstractmethod
+    async def subtree(self, path: Path) -> None:
+        pass
+
+    async def flush(self, path: Path) -> None:
+        """
+        Called when the memory is short: upload the files written in
+        path so far, if they're held in memory
+        """
+        pass
+
+    @abstractmethod
+    async def finish(self) -> str:
+        pass
+
+
+class TreeUploader(ArchiveUploader):
+    """
+    Adds each complete subtree to IPFS as soon as it's ready. When finishing,
+    the root is assembled in MFS by linking the subtrees and writing the
+    files at the root of the archive.
+
+    add_opts are passed to add_tree() (chunker, raw_leaves, nocopy,
+    only_hash), progress is called with every added entry.
+    """
+
+    def __init__(self, client: aioipfs.AsyncIPFS,
+                 rootp: Path, mfsp: str,
+                 add_opts: dict = {},
+                 progress: Optional[Callable[[dict], None]] = None):
+        super().__init__(client, rootp, mfsp)
+
+        self.add_opts = add_opts
+        self.progress = progress
+        self.subtrees: Dict[Path, str] = {}
+
+    @property
+    def only_hash(self) -> bool:
+        return self.add_opts.get('only_hash', False)
+
+    async def add_dir(self, path: Path) -> str:
+        cid = None
+
+        async for entry in add_tree(self.client, path, **self.add_opts):
+            if self.progress:
+                self.progress(entry)
+
+            if entry.get('Name') == path.name:
+                cid = entry['Hash']
+
+        if not cid:
+            raise ValueError(f'{path}: no CID returned for the directory')
+
+        return cid
+
+    async def subtree(self, path: Path) -> None:
+        if not self.only_hash:
+            self.subtrees[path] = await self.add_dir(path)
+
+    async def finish(self) -> str:
+        if self.only_hash:
+            # Nothing is stored, so the root can't be assembled in MFS:
+            # hash the whole tree in one go
+            return await self.add_dir(self.rootp)
+
+        await self.mfs_reset()
+        await self.client.files.mkdir(self.mfsp, parents=True,
+                                      cid_version=1)
+
+        for path in sorted(self.rootp.iterdir()):
+            if path.is_dir():
+                cid = self.subtrees.get(path)
+
+                if not cid:
+                    cid = await self.add_dir(path)
+
+                await self.client.files.cp(f'/ipfs/{cid}',
+                                           self.mfs_path(path))
+            elif path.is_file():
+                await self.write_file(path)
+
+        return await self.root_cid()
+
+
+class PatchUploader(ArchiveUploader):
+    """
+    Patches the generated files into the tree of the previous archive (the
+    base IPFS path) in MFS. The previous archive is only linked in MFS
+    (files/cp), it's never downloaded.
+
+    The pages of an index (page/N.html) are always generated with the
+    index, so when an index.html is written, the previous pages are
+    removed (there may be fewer pages now).
+    """
+
+    def __init__(self, client: aioipfs.AsyncIPFS,
+                 rootp: Path, mfsp: str,
+                 base: Optional[str] = None):
+        super().__init__(client, rootp, mfsp)
+
+        self.base = base
+        self.subtrees = set()
+
+    async def start(self) -> None:
+        await self.mfs_reset()
+
+        if self.base:
+            await self.client.files.cp(self.base, self.mfsp, parents=True)
+        else:
+            await self.client.files.mkdir(self.mfsp, parents=True,
+                                          cid_version=1)
+
+    async def write_tree(self, path: Path) -> None:
+        files = [fpath for fpath in sorted(path.rglob('*'))
+                 if fpath.is_file() and not any(
+                     sub in fpath.parents for sub in self.subtrees)]
+
+        for fpath in files:
+            if fpath.name == 'index.html':
+                await self.mfs_rm(self.mfs_path(fpath.with_name('page')))
+
+        for fpath in files:
+            await self.write_file(fpath)
+
+    async def subtree(self, path: Path) -> None:
+        await self.write_tree(path)
+
+        self.subtrees.add(path)
+
+    async def finish(self) -> str:
+        await self.write_tree(self.rootp)
+
+        return await self.root_cid()
+
+
+class CarUploader(ArchiveUploader):
+    """
+    Builds the DAG of the archive in-process and writes it to a CAR file
+    (carp), without an IPFS node. The CAR file can be imported on a node
+    with 'ipfs dag import'.
+
+    Only the fixed-size chunker (size-N) is supported.
+    """
+
+    def __init__(self, rootp: Path, carp: Path,
+                 chunker: Optional[str] = None,
+                 raw_leaves: bool = True):
+        super().__init__(None, rootp, '')
+
+        if chunker and not chunker.startswith('size-'):
+            raise ValueError(f'Unsupported chunker for CAR export: {chunker}')
+
+        self.car = CarWriter(carp)
+        self.builder = DagBuilder(
+            self.car,
+            chunk_size=int(chunker[5:]) if chunker else DEFAULT_CHUNK_SIZE,
+            raw_leaves=raw_leaves
+        )
+        self.subtrees: Dict[Path, DagNode] = {}
+
+    async def start(self) -> None:
+        self.car.open()
+
+    async def subtree(self, path: Path) -> None:
+        self.subtrees[path] = await asyncio.get_running_loop().run_in_executor(
+            None, self.builder.add_dir, path)
+
+    async def finish(self) -> str:
+        root = await asyncio.get_running_loop().run_in_executor(
+            None, self.builder.add_dir, self.rootp, self.subtrees)
+
+        self.car.close(root.cid)
+        return cid_str(root.cid)
+
+
+class StreamUploader(PatchUploader):
+    """
+    Uploads the archive's files generated in memory (see output.py), without
+    writing anything to disk. The files of each board are streamed to IPFS
+    in a single add request, and patched into the tree of the previous
+    archive in MFS (as with PatchUploader). The files at the root of the
+    archive are added the same way when finishing.
+
+    The files are only dropped from the output once they're in MFS: the
+    boards that failed to upload are uploaded again when finishing.
+    """
+
+    def __init__(self, client: aioipfs.AsyncIPFS,
+                 rootp: Path, mfsp: str,
+                 base: Optional[str] = None,
+                 add_opts: dict = {},
+                 progress: Optional[Callable[[dict], None]] = None):
+        super().__init__(client, rootp, mfsp, base=base)
+
+        self.add_opts = add_opts
+        self.progress = progress
+        self.failed: Set[Path] = set()
+
+    async def add_files(self, path: Path) -> None:
+        files = output.under(path)
+
+        if not files:
+            return
+
+        cids = {}
+
+        async for entry in add_form(self.client,
+                                    memory_multipart(path, files),
+                                    add_params(**self.add_opts)):
+            if self.progress:
+                self.progress(entry)
+
+            cids[entry.get('Name')] = entry.get('Hash')
+
+        mfsdir = self.mfsp if path == self.rootp else self.mfs_path(path)
+
+        await self.client.files.mkdir(mfsdir, parents=True, cid_version=1)
+
+        children = set(fpath.relative_to(path).parts[0] for fpath in files)
+
+        if 'index.html' in children:
+            # The previous pages of the index (see PatchUploader)
+            await self.mfs_rm(f'{mfsdir}/page')
+
+        # Replace the entries of the directory that were generated
+        for child in sorted(children):
+            await self.mfs_rm(f'{mfsdir}/{child}')
+
+            cid = cids[f'{path.name}/{child}']
+
+            await self.client.files.cp(f'/ipfs/{cid}', f'{mfsdir}/{child}')
+
+        output.drop(files)
+
+    async def subtree(self, path: Path) -> None:
+        try:
+            await self.add_files(path)
+        except Exception:
+            self.failed.add(path)
+            raise
+
+        self.failed.discard(path)
+
+    async def flush(self, path: Path) -> None:
+        await self.add_files(path)
+
+    async def finish(self) -> str:
+        # The boards are added on their own, not as part of the root's
+        # files (that would replace their unchanged threads)
+        for path in sorted(self.failed):
+            await self.subtree(path)
+
+        await self.add_files(self.rootp)
+
+        return await self.root_cid()
@@ -0,0 +1,146 @@
+import io
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import TextIO
+
+from .metrics import metrics
+
+
+class MemoryTextFile(io.StringIO):
+    """
+    Text file kept in memory, stored in the output when it's closed
+    """
+
+    def __init__(self, output: 'Output', path: Path):
+        super().__init__()
+
+        self.output = output
+        self.path = path
+
+    def close(self) -> None:
+        if not self.closed:
+            self.output.write(self.path, self.getvalue().encode())
+
+        super().close()
+
+
+class Output:
+    """
+    Destination of the files generated for the archive (the paths are the
+    paths in the archive's directory).
+
+    By default the files are written to the filesystem. In memory mode,
+    they're kept in memory (nothing is written to disk) until they're
+    taken by the uploader with take(), which streams them to IPFS, or
+    dropped.
+    """
+
+    def __init__(self):
+        self.memory: bool = False
+        self.files: Dict[Path, bytes] = {}
+
+    def configure(self, memory: bool = False) -> None:
+        self.memory = memory
+        self.files = {}
+
+    def mkdir(self, path: Path) -> None:
+        if not self.memory:
+            path.mkdir(parents=True, exist_ok=True)
+
+    def exists(self, path: Path) -> bool:
+        if self.memory:
+            return path in self.files
+
+        return path.is_file()
+
+    def read(self, path: Path) -> bytes:
+        if self.memory and path in self.files:
+            return self.files[path]
+
+        return path.read_bytes()
+
+    def write(self, path: Path, data: bytes) -> None:
+        if self.memory:
+            self.files[path] = data
+        else:
+            with metrics.timer('write'):
+                with open(path, 'wb') as fd:
+                    fd.write(data)
+
+    def open(self, path: Path) -> TextIO:
+        """
+        Open a text file (UTF-8) for writing
+        """
+        if self.memory:
+            return MemoryTextFile(self, path)
+
+        return open(path, 'wt', encoding='utf-8')
+
+    def replace(self, path: Path, chunks: Iterable[bytes],
+                keep: Optional[Callable[[], bool]] = None) -> None:
+        """
+        Write a file from chunks, as they are generated. On the filesystem,
+        the chunks are written to a temporary file, which replaces the file
+        once it's complete, unless the file exists and keep() (called once
+        all the chunks have been consumed) returns True.
+        """
+        if self.memory:
+            self.files[path] = b''.join(chunks)
+            return
+
+        tmpp = path.with_name(path.name + '.tmp')
+        wtime = 0.0
+
+        try:
+            with open(tmpp, 'wb') as fd:
+                for chunk in chunks:
+                    start = time.perf_counter()
+                    fd.write(chunk)
+                    wtime += time.perf_counter() - start
+
+            if not (keep and keep() and path.is_file()):
+                os.replace(tmpp, path)
+        finally:
+            metrics.observe('write', wtime)
+
+            if tmpp.is_file():
+                tmpp.unlink()
+
+    def rmtree(self, path: Path) -> None:
+        if self.memory:
+            self.take(path)
+        elif path.is_dir():
+            shutil.rmtree(path)
+
+    def under(self, path: Optional[Path] = None) -> Dict[Path, bytes]:
+        """
+        The in-memory files under path (all of them if path is None)
+        """
+        return {fpath: data for fpath, data in self.files.items()
+                if path is None or fpath == path or path in fpath.parents}
+
+    def drop(self, paths: Iterable[Path]) -> None:
+        for fpath in paths:
+            self.files.pop(fpath, None)
+
+    def take(self, path: Optional[Path] = None) -> Dict[Path, bytes]:
+        """
+        Remove the in-memory files under path (all of them if path is None)
+        and return them
+        """
+        taken = self.under(path)
+        self.drop(taken)
+
+        return taken
+
+    def merge(self, files: Dict[Path, bytes]) -> None:
+        self.files.update(files)
+
+
+output = Output()
@@ -0,0 +1,213 @@
+import asyncio
+import traceback
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import Callable
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+
+from .metrics import collected
+from .metrics import metrics
+from .output import output
+from .records import ThreadData
+
+if TYPE_CHECKING:
+    from .mfs import ArchiveUploader
+
+
+def render_worker(render: Callable, labels: dict, *args) -> tuple:
+    """
+    Render a thread in a worker process. Returns the digest, the metrics
+    recorded by the worker, and the files it generated in memory.
+    """
+    digest, wmetrics = collected(render, labels, *args)
+
+    return digest, wmetrics, output.take()
+
+
+class ThreadJob(NamedTuple):
+    """
+    A thread to render and write
+    """
+
+    board_fp: str
+    data: ThreadData
+    threadp: Path
+
+    # Digest of the thread's page in the previous archive, and current state
+    digest: Optional[str]
+    state: dict
+
+
+class Pipeline:
+    """
+    Staged sync pipeline.
+
+    The threads loaded by the producer (the main loop, calling thread()) are
+    rendered and streamed to disk by a number of renderer tasks. The writer
+    task records the digests of the written pages. The bounded queues between
+    the stages provide back-pressure, so that the producer waits when the
+    renderers can't keep up.
+
+    When all the threads of a board (closed with board_done()) have been
+    written, the board's directory is passed to the uploader while the
+    next boards are being processed.
+
+    The render workers write to their own output: if it's in memory, the
+    files they generate are sent back and merged in this process's output.
+
+    The uploads go on if one of them fails, but the first error is raised
+    by join(), so that the run fails before the threads state is saved
+    (the threads of the board would be considered unchanged afterwards).
+    """
+
+    def __init__(self,
+                 render: Callable[[ThreadData, Path, Optional[str]],
+                                  Optional[str]],
+                 tstates: Dict[str, dict],
+                 uploader: Optional['ArchiveUploader'] = None,
+                 executor: Optional[Executor] = None,
+                 renderers: int = 1,
+                 queue_size: int = 2):
+        self.render = render
+        self.tstates = tstates
+        self.uploader = uploader
+        self.executor = executor
+        self.renderers = renderers
+
+        self.render_q: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.write_q: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.upload_q: asyncio.Queue = asyncio.Queue()
+
+        # board fingerprint -> number of threads not written yet
+        self._pending: Dict[str, int] = {}
+
+        # boards for which all the threads have been queued
+        self._closed: Dict[str, Path] = {}
+
+        # First upload error, raised by join()
+        self.error: Optional[Exception] = None
+
+        self._tasks = []
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.ensure_future(self._renderer())
+            for _ in range(self.renderers)
+        ]
+        self._tasks.append(asyncio.ensure_future(self._writer()))
+        self._tasks.append(asyncio.ensure_future(self._uploader()))
+
+    async def thread(self, board_fp: str, data: ThreadData,
+                     threadp: Path,
+                     digest: Optional[str], state: dict) -> None:
+        self._pending[board_fp] = self._pending.get(board_fp, 0) + 1
+
+        await self.render_q.put(
+            ThreadJob(board_fp, data, threadp, digest, state))
+
+    def board_done(self, board_fp: str, boardp: Path) -> None:
+        """
+        Called once all the threads of a board have been queued
+        """
+        self._closed[board_fp] = boardp
+        self._check_board(board_fp)
+
+    def _check_board(self, board_fp: str) -> None:
+        if self._pending.get(board_fp, 0) == 0 and board_fp in self._closed:
+            self.upload_q.put_nowait(self._closed.pop(board_fp))
+
+    async def _renderer(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job = await self.render_q.get()
+            args = (job.data, job.threadp.joinpath('index.html'), job.digest)
+            labels = {'board': job.board_fp}
+
+            try:
+                with metrics.timer('render', **labels):
+                    if self.executor:
+                        digest, wmetrics, files = await loop.run_in_executor(
+                            self.executor, render_worker, self.render, labels,
+                            *args)
+                        metrics.merge(wmetrics)
+                        output.merge(files)
+                    else:
+                        with metrics.labels(**labels):
+                            digest = self.render(*args)
+            except Exception:
+                traceback.print_exc()
+                digest = None
+
+            await self.write_q.put((job, digest))
+            self.render_q.task_done()
+
+    async def _writer(self) -> None:
+        while True:
+            job, digest = await self.write_q.get()
+
+            if digest:
+                self.tstates[job.data.thread.Fingerprint] = dict(
+                    job.state, hash=digest)
+
+            self._pending[job.board_fp] -= 1
+            self._check_board(job.board_fp)
+
+            self.write_q.task_done()
+
+    async def _uploader(self) -> None:
+        while True:
+            path = await self.upload_q.get()
+
+            try:
+                if self.uploader:
+                    with metrics.timer('ipfs_add', step='subtree'):
+                        await self.uploader.subtree(path)
+                else:
+                    # Nothing to upload to, drop the files held in memory
+                    output.take(path)
+            except Exception as err:
+                traceback.print_exc()
+
+                if self.error is None:
+                    self.error = err
+
+            self.upload_q.task_done()
+
+    async def flush(self, path: Path) -> None:
+        """
+        Wait until every queued thread has been written, and flush the
+        files written in path so far (see ArchiveUploader.flush)
+        """
+        await self.render_q.join()
+        await self.write_q.join()
+
+        if self.uploader:
+            await self.uploader.flush(path)
+        else:
+            output.take(path)
+
+    async def join(self) -> None:
+        """
+        Wait until every queued thread has been written and every complete
+        board uploaded, and stop the stages
+        """
+        await self.render_q.join()
+        await self.write_q.join()
+        await self.upload_q.join()
+        await self.stop()
+
+        if self.error:
+            raise self.error
+
+    async def stop(self) -> None:
+        """
+        Cancel the stages (the threads still queued are dropped)
+        """
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,110 @@
+import cProfile
+import os
+import resource
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Optional
+
+
+def rss() -> int:
+    """
+    Resident set size of this process, in bytes (the peak RSS on systems
+    without /proc)
+    """
+    try:
+        with open('/proc/self/statm', 'rt') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        scale = 1 if sys.platform == 'darwin' else 1024
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Profiler:
+    """
+    Profiles the stages of a sync with cProfile (a .prof file per stage is
+    written in outdir), and/or traces the memory allocations with
+    tracemalloc (the top allocators are printed after each board).
+
+    A stage lasts until the next one starts: stage('setup'),
+    stage('board-...'), ... The threads are rendered by the pipeline's
+    tasks while the next boards are loaded, so a board's rendering can
+    partly be accounted to the next stage. The render workers (if any)
+    are not profiled.
+    """
+
+    def __init__(self):
+        self.outdir: Optional[Path] = None
+        self.trace_memory: bool = False
+        self.top: int = 10
+
+        self._profile: Optional[cProfile.Profile] = None
+        self._stage: Optional[str] = None
+        self._count: int = 0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+    def configure(self, outdir: Optional[Path] = None,
+                  trace_memory: bool = False,
+                  top: int = 10) -> None:
+        self.outdir = outdir
+        self.trace_memory = trace_memory
+        self.top = top
+
+        if outdir:
+            outdir.mkdir(parents=True, exist_ok=True)
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name: str) -> None:
+        """
+        Start profiling a new stage (the previous one is dumped)
+        """
+        if not self.outdir:
+            return
+
+        self.stop()
+
+        self._count += 1
+        self._stage = f'{self._count:03}-{name}'
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self) -> None:
+        if not self._profile:
+            return
+
+        self._profile.disable()
+        self._profile.dump_stats(
+            str(self.outdir.joinpath(f'{self._stage}.prof')))
+        self._profile = None
+
+    def memory(self, label: str) -> None:
+        """
+        Print the memory usage and the top allocators (by growth since the
+        previous snapshot)
+        """
+        if not self.trace_memory:
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+
+        print(f'Memory after {label}: {current / 1048576:.1f} MiB '
+              f'(peak: {peak / 1048576:.1f} MiB)')
+
+        if self._snapshot:
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+        else:
+            stats = snapshot.statistics('lineno')
+
+        for stat in stats[:self.top]:
+            print(f'    {stat}')
+
+        self._snapshot = snapshot
+
+
+profiler = Profiler()
@@ -0,0 +1,210 @@
+import asyncio
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import List
+from typing import Optional
+
+import aiohttp
+import aioipfs
+
+from .metrics import metrics
+
+
+# Every status of a remote pin
+PIN_STATUSES = ['queued', 'pinning', 'pinned', 'failed']
+
+# Errors after which a request is retried
+RETRIED_ERRORS = (aioipfs.APIError, aioipfs.IPFSConnectionError,
+                  aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def error_str(err: Exception) -> str:
+    return getattr(err, 'message', None) or repr(err)
+
+
+async def answered(request: Awaitable, what: str,
+                   empty: bool = False) -> object:
+    """
+    Await an aioipfs request and return its result. aioipfs returns None
+    instead of raising on connection errors and timeouts (even when the
+    request is cancelled), so an API error is raised if there's no
+    result (or an empty one, unless empty is True).
+    """
+    result = await request
+
+    if result is None or not (result or empty):
+        raise aioipfs.APIError(message=f'{what}: no response from the node')
+
+    return result
+
+
+async def retried(call: Callable[[], Awaitable],
+                  what: str,
+                  retries: int = 0,
+                  timeout: Optional[float] = None,
+                  delay: float = 2) -> object:
+    """
+    Await call() with a timeout. After an API, connection or timeout
+    error, it's retried (at most retries times), waiting delay seconds
+    (doubled after each failure) between the attempts.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.wait_for(call(), timeout)
+        except RETRIED_ERRORS as err:
+            if attempt == retries:
+                raise
+
+            print(f'{what} failed ({error_str(err)}), retrying in {delay}s')
+
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def ipns_publish(client: aioipfs.AsyncIPFS,
+                       cid: str,
+                       key: str,
+                       pubcfg: dict = {}) -> dict:
+    """
+    Publish a CID to the IPNS key, with the lifetime, ttl and
+    allow_offline settings of pubcfg (the ipfs.publish section)
+    """
+    params = {
+        'arg': f'/ipfs/{cid}',
+        'key': key,
+        'lifetime': pubcfg.get('lifetime', '24h'),
+        'allow-offline': 'true' if pubcfg.get('allow_offline') else 'false'
+    }
+
+    if pubcfg.get('ttl'):
+        # aioipfs only passes integers, the API wants a duration
+        params['ttl'] = str(pubcfg['ttl'])
+
+    with metrics.timer('ipfs_publish'):
+        return await retried(
+            lambda: answered(client.name.fetch_json(
+                client.name.url('name/publish'), params=params),
+                'IPNS publish'),
+            'IPNS publish',
+            retries=pubcfg.get('retries', 2),
+            timeout=pubcfg.get('timeout', 600),
+            delay=pubcfg.get('retry_delay', 2)
+        )
+
+
+async def remote_pins(client: aioipfs.AsyncIPFS,
+                      service: str,
+                      name: Optional[str] = None,
+                      cids: List[str] = []) -> List[dict]:
+    """
+    Remote pins (with any status) with this name and/or these CIDs
+    """
+    return [pin async for pin in client.pin.remote.ls(
+        service, name=name, cid=cids, status=PIN_STATUSES)]
+
+
+async def pin_remote(client: aioipfs.AsyncIPFS,
+                     cid: str,
+                     prcfg: dict) -> bool:
+    """
+    Pin a CID to the remote pinning service, replacing the previous
+    archive's pin (the pins with the same name).
+
+    The new pin is added first (in the background on the service), its
+    status is polled until it's pinned, and only then the previous pins
+    are removed, so that an archive is always pinned. If the pin fails
+    or isn't pinned in time, the previous pins are kept. Returns True if
+    the CID is pinned.
+    """
+    service, name = prcfg['service'], prcfg['pin_name']
+    opts = {
+        'retries': prcfg.get('retries', 3),
+        'timeout': prcfg.get('request_timeout', 60),
+        'delay': prcfg.get('retry_delay', 2)
+    }
+
+    pins = await retried(lambda: remote_pins(client, service, name=name),
+                         'Remote pins listing', **opts)
+
+    if not any(pin.get('Cid') == cid for pin in pins):
+        with metrics.timer('ipfs_pin', op='add'):
+            await retried(
+                lambda: answered(client.pin.remote.add(
+                    service, cid, name=name, background=True),
+                    'Remote pin'),
+                'Remote pin', **opts)
+
+    deadline = time.monotonic() + prcfg.get('timeout', 3600)
+
+    with metrics.timer('ipfs_pin', op='wait'):
+        while True:
+            statuses = [
+                pin.get('Status') for pin in await retried(
+                    lambda: remote_pins(client, service, cids=[cid]),
+                    'Remote pin status', **opts)
+                if pin.get('Name') == name
+            ]
+
+            if 'pinned' in statuses:
+                break
+            elif 'failed' in statuses:
+                print(f'Remote pinning of {cid} failed, '
+                      'keeping the previous pins')
+                return False
+            elif time.monotonic() >= deadline:
+                # The pin may not be listed yet
+                status = statuses[0] if statuses else 'not listed'
+
+                print(f'Remote pinning of {cid} timed out ({status}), '
+                      'keeping the previous pins')
+                return False
+
+            await asyncio.sleep(prcfg.get('poll_interval', 10))
+
+    old = [pin['Cid'] for pin in pins if pin.get('Cid') != cid]
+
+    if old:
+        # The API answers with an empty body, which the JSON request of
+        # aioipfs can't tell from an error: the text is requested instead
+        params = [('service', service), ('name', name), ('force', 'true')]
+        params += [('cid', ocid) for ocid in old]
+        params += [('status', status) for status in PIN_STATUSES]
+
+        try:
+            with metrics.timer('ipfs_pin', op='rm'):
+                await retried(
+                    lambda: answered(client.pin.remote.post(
+                        client.pin.remote.url('pin/remote/rm'),
+                        params=params), 'Remote unpin', empty=True),
+                    'Remote unpin', **opts)
+        except RETRIED_ERRORS as err:
+            print(f'Failed to remove the previous remote pins: '
+                  f'{error_str(err)}')
+
+    return True
+
+
+async def publish(client: aioipfs.AsyncIPFS,
+                  cid: str,
+                  key: str,
+                  ipfscfg: dict) -> None:
+    """
+    Publish the archive's CID to IPNS and pin it remotely (if enabled),
+    concurrently. An IPNS publish error is raised once the remote pinning
+    is done.
+    """
+    prcfg = ipfscfg.get('pinremote', {})
+    tasks = [ipns_publish(client, cid, key, ipfscfg.get('publish', {}))]
+
+    if prcfg.get('enabled'):
+        tasks.append(pin_remote(client, cid, prcfg))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    if prcfg.get('enabled') and results[1]:
+        print(f'https://{cid}.ipfs.dweb.link')
@@ -1,96 +1,199 @@
-import asyncio
+import functools
+import hashlib
 import re
 import os
 import tempfile
 import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from datetime import timezone
+from importlib import resources
+from typing import TYPE_CHECKING
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
 from typing import Union
 from typing import List
 
-import aioipfs
-import aiofiles
-import ipfshttpclient
-from yarl import URL
-
 import shutil
-import markdown
-import pkg_resources
+import sys
 
 from yattag import Doc
 from yattag import indent
 
-from feedgen.feed import FeedGenerator
+from .database import db
+from .database import sql_datetime
+from .md import renderer as mdrenderer
+from .feeds import FeedEntry
+from .feeds import FeedSet
+from .feeds import FeedWriter
+from .feeds import PURRSIST_URL
+from .identities import identities
+from .records import BoardRecord
+from .records import IdentityRecord
+from .records import PostRecord
+from .records import ThreadData
+from .records import ThreadIndexEntry
+from .records import ThreadRecord
+from .selection import BoardsSelection
+from .selection import NameFilter
+from .metrics import metrics
+from .output import output
+from .pipeline import Pipeline
+from .profiling import profiler
+from .profiling import rss
+from .state import STATE_FILENAME
+from .state import board_threads_state
+from .state import state_load
+from .state import state_save
+from .state import state_unchanged
+
+if TYPE_CHECKING:
+    import aioipfs
+
+
+# Stylesheets written at the root of the archive (name -> package resource)
+STYLESHEETS = {
+    'style.css': 'awsm_theme_big-stone.css',
+    'aether.css': 'aether.css'
+}
+
+
+# Placeholder for the posts in the skeleton of a thread's page
+POSTS_MARKER = '<!--purrsist-posts-->'
+
+# With max_threads and name filters, number of threads read for each
+# thread that's still missing (some of them will be filtered)
+THREADS_OVERFETCH = 2
+
 
-from .models import Boards
-from .models import Posts
-from .models import PublicKeys
-from .models import Threads
-from .models import Votes
-from .md import is_markdown
+def mkd(path: Path):
+    output.mkdir(path)
 
 
-aethcssp = Path(pkg_resources.resource_filename('aether_purrsist',
-                                                'aether.css'))
-cssp = Path(pkg_resources.resource_filename('aether_purrsist',
-                                            'awsm_theme_big-stone.css'))
+async def boards_selection(boards_list: dict):
+    selection = BoardsSelection(boards_list)
 
+    for board in await db.boards():
+        bcfg = selection.match(board)
 
-def mkd(path: Path):
-    path.mkdir(parents=True, exist_ok=True)
+        if bcfg is not None:
+            yield board, bcfg
 
 
-async def boards_selection(boards_list: list):
-    fps = []
+async def board_threads(board_fp: str,
+                        max_threads: int = 0,
+                        name_filter: Optional[NameFilter] = None,
+                        batch_size: int = 500
+                        ) -> AsyncIterator[List[ThreadRecord]]:
+    """
+    Threads of a board to archive, newest first: the threads whose name
+    is filtered are skipped, and at most max_threads threads are yielded.
+
+    The threads are read and yielded in pages of (at most) batch_size
+    threads (keyset pagination), so only one page is held in memory at
+    a time. With max_threads, a page is no larger than the number of
+    threads that are still missing (times THREADS_OVERFETCH if the names
+    are filtered).
+    """
+    after = None
+    count = 0
 
-    for board in await Boards.all().order_by('Name'):
-        for regex, bcfg in boards_list.items():
-            bcfg_fp = bcfg.get('fingerprint')
+    while True:
+        size = batch_size
 
-            if board.Fingerprint in fps:
-                continue
+        if max_threads:
+            size = min(batch_size, (max_threads - count) * (
+                THREADS_OVERFETCH if name_filter else 1))
 
-            if bcfg_fp and board.Fingerprint == bcfg_fp:
-                fps.append(bcfg_fp)
-                yield board, bcfg
+        batch, after = await db.threads_page(board_fp, size, after=after)
+        threads = [thread for thread in batch if not (
+            name_filter and name_filter.filtered(thread.Name))]
 
-                continue
-            elif re.search(rf'^{regex}$', board.Name) and not bcfg_fp:
-                fps.append(board.Fingerprint)
-                yield board, bcfg
+        if max_threads:
+            threads = threads[:max_threads - count]
 
+        if threads:
+            yield threads
+            count += len(threads)
 
-async def write_doc(doc: Doc, path: Path) -> bool:
+        if len(batch) < size or (max_threads and count >= max_threads):
+            return
+
+
+async def write_html(html: str, path: Path,
+                     digest: Optional[str] = None) -> Optional[str]:
+    """
+    Write an HTML page and return the SHA-256 digest of its content
+    (None if it failed). The file is not rewritten if it already exists
+    and its previous digest is passed and matches.
+    """
     try:
-        async with aiofiles.open(str(path), 'w+t') as fd:
-            await fd.write(indent(doc.getvalue()))
+        data = html.encode()
+        hexd = hashlib.sha256(data).hexdigest()
 
-        return True
+        if hexd == digest and output.exists(path):
+            return hexd
+
+        output.write(path, data)
+
+        metrics.add('bytes_written', len(data), kind='index')
+        return hexd
     except Exception:
         traceback.print_exc()
-        return False
+        return None
 
 
-async def pubkey(fingerprint: str) -> PublicKeys:
+def write_chunks(chunks: Iterable[str], path: Path,
+                 digest: Optional[str] = None) -> Optional[str]:
     """
-    Return the PublicKeys instance for a given fingerprint.
-    This allows us to get the name of a user by fingerprint.
+    Write a page from chunks of HTML as they are generated, and return the
+    SHA-256 digest of its content (None if it failed). The page replaces
+    the existing page unless its previous digest is passed and matches
+    (see Output.replace).
     """
-    return await PublicKeys.filter(
-        Fingerprint=fingerprint
-    ).first()
+    sha = hashlib.sha256()
+    size = 0
 
+    def hashed() -> Iterator[bytes]:
+        nonlocal size
 
-pidx = 0
-gendate = datetime.now().strftime('%d-%m-%Y %I:%M %p')
+        for chunk in chunks:
+            data = chunk.encode()
+            sha.update(data)
+            size += len(data)
+            yield data
 
+    try:
+        output.replace(path, hashed(),
+                       keep=lambda: sha.hexdigest() == digest)
+
+        metrics.add('bytes_written', size, kind='thread')
+        return sha.hexdigest()
+    except Exception:
+        traceback.print_exc()
+        return None
 
-def pcssc():
-    global pidx
 
-    pidx += 1
-    mod = divmod(pidx, 3)[1]
+async def write_doc(doc: Doc, path: Path,
+                    digest: Optional[str] = None) -> Optional[str]:
+    return await write_html(indent(doc.getvalue()), path, digest=digest)
+
+
+async def pubkey(fingerprint: str) -> Optional[IdentityRecord]:
+    """
+    Return the identity (PublicKeys row) for a given fingerprint.
+    This allows us to get the name of a user by fingerprint.
+    """
+    return await identities.get(fingerprint)
+
+
+def pcssc(idx: int) -> str:
+    mod = divmod(idx, 3)[1]
 
     if mod == 0:
         return 'aether-post-cold'
@@ -100,7 +203,7 @@ def pcssc():
         return 'aether-post-dark'
 
 
-def footer(doc: Doc):
+def footer(doc: Doc, date: Optional[str] = None):
     tag = doc.tag
     text = doc.text
 
@@ -113,45 +216,72 @@ def footer(doc: Doc):
             with tag('a', href='https://gitlab.com/galacteek/aether-purrsist'):
                 text('aether-purrsist')
 
-            text(f' ({gendate})')
+            if date:
+                text(f' ({date})')
 
 
-def show_usernick(doc: Doc, owner) -> None:
-    with doc.tag('h3', klass='aether-nickname'):
-        if owner:
-            doc.text(f'@{owner.Name}')
-        else:
-            doc.text('Unknown user')
+def page_path(dirp: Path, page: int) -> Path:
+    """
+    Path of a page of a paginated index (the first page is index.html)
+    """
+    if page == 1:
+        return dirp.joinpath('index.html')
+    else:
+        return dirp.joinpath('page').joinpath(f'{page}.html')
 
 
-def show_date(doc: Doc, obj: Union[Threads, Boards, Posts]) -> None:
-    with doc.tag('h4'):
-        doc.text(obj.LocalArrival.strftime('%d-%m-%Y %I:%M %p'))
+def page_href(page: int, from_page: int) -> str:
+    """
+    Link to a page of a paginated index, relative to another page
+    """
+    if page == 1:
+        return 'index.html' if from_page == 1 else '../index.html'
+    else:
+        return f'page/{page}.html' if from_page == 1 else f'{page}.html'
 
 
-def votes_score(votes: List[Votes]) -> int:
+def pages_digest(digests: List[str]) -> str:
     """
-    Compute the score for a post given a list of votes
+    Digest of a paginated index, from the digests of its pages
     """
+    return hashlib.sha256(''.join(digests).encode()).hexdigest()
 
-    score: int = 0
 
-    for vote in votes:
-        # Not sure what other values of TypeClass exist
-        if vote.TypeClass != 1:
-            continue
+def pages_nav(doc: Doc, page: int, pages: int) -> None:
+    """
+    Navigation links between the pages of a paginated index
+    """
+    tag = doc.tag
+    text = doc.text
 
-        if vote.Type == 1:
-            score += 1
-        elif vote.Type == 2:
-            score -= 1
+    with tag('div', klass='purrsist-pages'):
+        if page > 1:
+            with tag('a', href=page_href(page - 1, page)):
+                text('Previous')
 
-    return score
+        with tag('span'):
+            text(f'Page {page} / {pages}')
 
+        if page < pages:
+            with tag('a', href=page_href(page + 1, page)):
+                text('Next')
 
-def show_score(doc: Doc, votes: List[Votes]) -> None:
-    score = votes_score(votes)
 
+def show_usernick(doc: Doc, owner) -> None:
+    with doc.tag('h3', klass='aether-nickname'):
+        if owner:
+            doc.text(f'@{owner.Name}')
+        else:
+            doc.text('Unknown user')
+
+
+def show_date(doc: Doc,
+              obj: Union[ThreadRecord, PostRecord]) -> None:
+    with doc.tag('h4'):
+        doc.text(obj.LocalArrival.strftime('%d-%m-%Y %I:%M %p'))
+
+
+def show_score(doc: Doc, score: int) -> None:
     if score != 0:
         with doc.tag('span',
                      klass='arrow-up' if score > 0 else 'arrow-down'):
@@ -159,109 +289,181 @@ def show_score(doc: Doc, votes: List[Votes]) -> None:
                 doc.text(score)
 
 
-def show_post_infos(doc: Doc, owner, obj: Union[Threads, Posts],
-                    votes: List[Votes] = []) -> None:
+def show_post_infos(doc: Doc, owner,
+                    obj: Union[ThreadRecord, PostRecord],
+                    score: int = 0) -> None:
     with doc.tag('p', klass='aether-post-infos'):
         with doc.tag('div', style='float: left'):
             show_usernick(doc, owner)
 
         with doc.tag('div', style='float: right'):
             show_date(doc, obj)
-            show_score(doc, votes)
+            show_score(doc, score)
 
         doc.stag('div', klass='clear')
 
 
-def show_body(doc: Doc, obj: Union[Threads, Posts]) -> None:
+def show_body(doc: Doc, obj: Union[ThreadRecord, PostRecord]) -> None:
     """
     This function outputs the body of a post or thread.
     It uses the markdown module if it detects markdown content.
     """
-    if is_markdown(obj.Body):
+    html = mdrenderer.html(obj.Body)
+
+    if html is not None:
         with doc.tag('p'):
-            doc.asis(markdown.markdown(
-                obj.Body,
-                extensions=[
-                    'attr_list',
-                    'fenced_code'
-                ]
-            ))
+            doc.asis(html)
     else:
         with doc.tag('pre'):
             doc.text(obj.Body)
 
 
-async def thread_posts_output(doc: Doc,
-                              board: Boards,
-                              thread: Threads, posts):
-    tag = doc.tag
+async def thread_data(board: BoardRecord,
+                      thread: ThreadRecord,
+                      scores: Dict[str, int]) -> ThreadData:
+    """
+    Load all the posts of a thread with one query, indexed in a
+    (parent -> replies) map, and pick the scores of the thread and its
+    posts from the (target -> score) map of its page of threads (see
+    Database.scores). The identities of the thread's authors are loaded
+    through the cache, with one query for the uncached ones.
+    """
+    replies: Dict[str, List[PostRecord]] = defaultdict(list)
+    owners = set([thread.Owner])
+    targets = [thread.Fingerprint]
+
+    for post in await db.posts(board.Fingerprint, thread.Fingerprint):
+        replies[post.Parent].append(post)
+        owners.add(post.Owner)
+        targets.append(post.Fingerprint)
+
+    return ThreadData(
+        thread,
+        replies,
+        {fp: scores[fp] for fp in targets if fp in scores},
+        await identities.preload(owners)
+    )
 
-    for idx, post in enumerate(posts):
-        owner = await pubkey(post.Owner)
 
-        # Replies to this post
-        replies = await Posts.filter(
-            Board=board.Fingerprint,
-            Thread=thread.Fingerprint,
-            Parent=post.Fingerprint
-        )
+def posts_walk(data: ThreadData,
+               roots: Optional[List[PostRecord]] = None
+               ) -> Iterator[Optional[PostRecord]]:
+    """
+    Walk the posts tree of a thread iteratively (depth-first, in the order
+    the posts were loaded: oldest first), from the given top-level posts
+    (all of them by default). Yields each post, and None when the replies
+    of the last opened post have all been walked.
+    """
+    if roots is None:
+        roots = data.replies.get(data.thread.Fingerprint, [])
 
-        with tag('div',
-                 klass='aether-post ' + pcssc()):
-            show_post_infos(
-                doc, owner, post,
-                votes=await Votes.filter(
-                    Board=board.Fingerprint,
-                    Thread=thread.Fingerprint,
-                    Target=post.Fingerprint
-                )
-            )
+    # One iterator per open level
+    stack = [iter(roots)]
+    seen = set()
 
-            show_body(doc, post)
+    while stack:
+        post = next(stack[-1], None)
 
-            if len(replies) > 0:
-                await thread_posts_output(doc, board, thread, replies)
+        if post is None:
+            stack.pop()
 
+            if stack:
+                yield None
 
-async def purrsist_thread(board: Boards,
-                          thread: Threads,
-                          threadp: Path,
-                          votes: List[Votes] = []) -> bool:
+            continue
+
+        if post.Fingerprint in seen:
+            continue
+
+        seen.add(post.Fingerprint)
+
+        yield post
+
+        stack.append(iter(data.replies.get(post.Fingerprint, [])))
+
+
+def thread_pages(data: ThreadData,
+                 posts_per_page: int = 0) -> List[List[PostRecord]]:
     """
-    Purrsist a given thread with all its posts
+    Split the posts of a thread in pages of about posts_per_page posts.
+    Pages only break between two top-level posts (and all their replies),
+    returns the top-level posts of each page.
     """
-    indexp = threadp.joinpath('index.html')
+    roots = data.replies.get(data.thread.Fingerprint, [])
 
-    posts = await Posts.filter(
-        Board=board.Fingerprint,
-        Thread=thread.Fingerprint,
-        Parent=thread.Fingerprint
-    )
+    if posts_per_page <= 0 or not roots:
+        return [roots]
+
+    pages: List[List[PostRecord]] = [[]]
+    count = 0
+
+    for root in roots:
+        size = sum(1 for post in posts_walk(data, [root]) if post)
+
+        if pages[-1] and count + size > posts_per_page:
+            pages.append([])
+            count = 0
+
+        pages[-1].append(root)
+        count += size
+
+    return pages
+
+
+def fragment_indent(html: str, level: int) -> str:
+    """
+    Indent an HTML fragment the way yattag's indent() does when the fragment
+    is nested at the given level of a document (each line starting with a
+    newline, like in the indented document).
+    """
+    if level == 0:
+        return '\n' + indent(html)
+
+    # Nest the fragment in placeholder tags, and strip them once indented
+    wrapped = indent('<x>' * level + html + '</x>' * level)
+
+    head = '<x>' + ''.join('\n' + '  ' * i + '<x>' for i in range(1, level))
+    tail = ''.join('\n' + '  ' * i + '</x>' for i in reversed(range(level)))
+
+    return wrapped[len(head):len(wrapped) - len(tail)]
+
+
+def thread_skeleton(data: ThreadData,
+                    page: int = 1,
+                    pages: int = 1,
+                    posts: bool = True) -> Doc:
+    """
+    A page of a thread, without the posts. If the page has posts,
+    the POSTS_MARKER comment marks the place where they go.
+    """
+    thread = data.thread
+    up = '' if page == 1 else '../'
 
     doc, tag, text = Doc().tagtext()
     doc.asis('<!DOCTYPE html>')
 
-    towner = await pubkey(thread.Owner)
-
     with tag('html'):
         with tag('head'):
             doc.stag('meta', charset='UTF-8')
             doc.stag('link',
                      rel='stylesheet',
-                     href='../../style.css')
+                     href=f'{up}../../style.css')
             doc.stag('link',
                      rel='stylesheet',
-                     href='../../aether.css')
+                     href=f'{up}../../aether.css')
 
             with tag('title'):
                 text(thread.Name)
 
         with tag('p'):
             with tag('div', klass='thread-name'):
-                with tag('a', href='.', klass='thread-name'):
+                with tag('a', href='.' if page == 1 else '..',
+                         klass='thread-name'):
                     text(thread.Name)
 
             if thread.Link:
+                from yarl import URL
+
                 url = URL(thread.Link)
                 ext = os.path.splitext(url.name)[1]
 
@@ -283,71 +485,244 @@ async def purrsist_thread(board: Boards,
         with tag('body'):
             with tag('div',
                      klass='aether-thread-body'):
-                show_post_infos(doc, towner, thread,
-                                votes=votes)
+                show_post_infos(doc, data.owners.get(thread.Owner), thread,
+                                score=data.scores.get(thread.Fingerprint, 0))
 
                 show_body(doc, thread)
 
             with tag('div'):
-                await thread_posts_output(doc, board, thread, posts)
+                if posts:
+                    doc.asis(POSTS_MARKER)
 
-    return await write_doc(doc, indexp)
+            if pages > 1:
+                pages_nav(doc, page, pages)
 
+            footer(doc)
 
-async def board_threads_index(board: Boards,
-                              boardp: Path,
-                              threads) -> bool:
+    return doc
+
+
+def thread_chunks(data: ThreadData,
+                  idx: int = 0,
+                  pretty: bool = True,
+                  roots: Optional[List[PostRecord]] = None,
+                  page: int = 1,
+                  pages: int = 1) -> Iterator[str]:
     """
-    Threads index for a community
+    Generate the HTML of a thread's page, in chunks: the page's head,
+    then each post as the posts tree is walked (from the roots top-level
+    posts, all of them by default), and the page's tail.
+
+    idx is the posts alternation index of the page's first post (the
+    posts of a thread are numbered from 0, across its pages).
+    If pretty is True, the chunks are indented like the whole page would
+    be by yattag's indent().
     """
-    indexp = boardp.joinpath('index.html')
+    if roots is None:
+        roots = data.replies.get(data.thread.Fingerprint, [])
 
-    doc, tag, text = Doc().tagtext()
-    doc.asis('<!DOCTYPE html>')
+    html = thread_skeleton(data, page=page, pages=pages,
+                           posts=len(roots) > 0).getvalue()
+
+    if pretty:
+        html = indent(html)
+
+    head, marker, tail = html.partition(POSTS_MARKER)
+
+    if not marker:
+        # No posts
+        yield html
+        return
+
+    level = 0
+
+    if pretty:
+        # Strip the marker's line, its indentation is the posts' level
+        head, nl = head.rsplit('\n', 1)
+        level = len(nl) // 2
+
+    def newline(level: int) -> str:
+        return '\n' + '  ' * level if pretty else ''
+
+    yield head
+
+    for post in posts_walk(data, roots):
+        if post is None:
+            level -= 1
+            yield newline(level) + '</div>'
+            continue
+
+        idx += 1
+
+        yield newline(level) + f'<div class="aether-post {pcssc(idx)}">'
+
+        doc = Doc()
+        show_post_infos(doc, data.owners.get(post.Owner), post,
+                        score=data.scores.get(post.Fingerprint, 0))
+        show_body(doc, post)
+
+        level += 1
+
+        if pretty:
+            yield fragment_indent(doc.getvalue(), level)
+        else:
+            yield doc.getvalue()
+
+    yield tail
 
+
+def render_thread(data: ThreadData, pretty: bool = True) -> str:
+    """
+    Render the page of a thread, returning the HTML
+    """
+    return ''.join(thread_chunks(data, pretty=pretty))
+
+
+def stream_thread(data: ThreadData,
+                  path: Path,
+                  digest: Optional[str] = None,
+                  pretty: bool = True,
+                  posts_per_page: int = 0) -> Optional[str]:
+    """
+    Render the page of a thread and write it as it's being generated.
+    Returns the digest of the page (see write_chunks).
+
+    If posts_per_page is set, the thread is split in pages: path is the
+    first page, the next ones are in the page directory next to it.
+    """
+    tpages = thread_pages(data, posts_per_page)
+    idx = 0
+
+    # Remove the pages of the previous version of the thread
+    output.rmtree(path.parent.joinpath('page'))
+
+    if len(tpages) == 1:
+        return write_chunks(thread_chunks(data, idx, pretty=pretty), path,
+                            digest=digest)
+
+    digests = []
+
+    for page, roots in enumerate(tpages, 1):
+        pagep = page_path(path.parent, page)
+        mkd(pagep.parent)
+
+        pdigest = write_chunks(
+            thread_chunks(data, idx, pretty=pretty, roots=roots,
+                          page=page, pages=len(tpages)),
+            pagep
+        )
+
+        if not pdigest:
+            return None
+
+        digests.append(pdigest)
+        idx += sum(1 for post in posts_walk(data, roots) if post)
+
+    return pages_digest(digests)
+
+
+async def purrsist_thread(board: BoardRecord,
+                          thread: ThreadRecord,
+                          threadp: Path,
+                          scores: Dict[str, int],
+                          digest: Optional[str] = None,
+                          pretty: bool = True,
+                          posts_per_page: int = 0) -> Optional[str]:
+    """
+    Purrsist a given thread with all its posts, with the scores of the
+    board (loaded once per board, see Database.scores).
+    Returns the digest of the thread's page (see stream_thread).
+    """
+    data = await thread_data(board, thread, scores)
+
+    return stream_thread(data, threadp.joinpath('index.html'),
+                         digest=digest, pretty=pretty,
+                         posts_per_page=posts_per_page)
+
+
+async def board_threads_index(board: BoardRecord,
+                              boardp: Path,
+                              threads: List[ThreadIndexEntry],
+                              threads_per_page: int = 0) -> Optional[str]:
+    """
+    Threads index for a community. If threads_per_page is set, the index
+    is split in pages (the first page is index.html, the next ones are
+    in the page directory).
+    """
     owner = await pubkey(board.Owner)
 
-    with tag('html'):
-        with tag('head'):
-            doc.stag('meta', charset='UTF-8')
-            doc.stag('link',
-                     rel='stylesheet',
-                     href='../style.css')
-            doc.stag('link',
-                     rel='stylesheet',
-                     href='../aether.css')
-            with tag('title'):
-                text(f'Aether archive: {board.Name}')
+    if threads_per_page > 0 and threads:
+        tpages = [threads[idx:idx + threads_per_page]
+                  for idx in range(0, len(threads), threads_per_page)]
+    else:
+        tpages = [threads]
 
-        with tag('body'):
-            with tag('div'):
-                with tag('h1'):
+    # Remove the pages of the previous index
+    output.rmtree(boardp.joinpath('page'))
+
+    digests = []
+
+    for page, pthreads in enumerate(tpages, 1):
+        up = '' if page == 1 else '../'
+
+        doc, tag, text = Doc().tagtext()
+        doc.asis('<!DOCTYPE html>')
+
+        with tag('html'):
+            with tag('head'):
+                doc.stag('meta', charset='UTF-8')
+                doc.stag('link',
+                         rel='stylesheet',
+                         href=f'{up}../style.css')
+                doc.stag('link',
+                         rel='stylesheet',
+                         href=f'{up}../aether.css')
+                with tag('title'):
                     text(f'Aether archive: {board.Name}')
 
-                if owner:
-                    with tag('h2', style='margin: 5px'):
-                        text(f'Created by: @{owner.Name}')
+            with tag('body'):
+                with tag('div'):
+                    with tag('h1'):
+                        text(f'Aether archive: {board.Name}')
 
-                with tag('ul'):
-                    for thread in threads:
-                        votes = await Votes.filter(
-                            Board=board.Fingerprint,
-                            Thread=thread.Fingerprint,
-                            Target=thread.Fingerprint
-                        )
+                    if owner:
+                        with tag('h2', style='margin: 5px'):
+                            text(f'Created by: @{owner.Name}')
 
-                        with tag('li'):
-                            with tag('a', href=thread.Fingerprint):
-                                text(thread.Name)
+                    with tag('ul'):
+                        for thread in pthreads:
+                            with tag('li'):
+                                with tag('a',
+                                         href=f'{up}{thread.Fingerprint}'):
+                                    text(thread.Name)
 
-                            show_score(doc, votes)
+                                show_score(doc, thread.Score)
 
-            footer(doc)
+                    if len(tpages) > 1:
+                        pages_nav(doc, page, len(tpages))
 
-    return await write_doc(doc, indexp)
+                footer(doc)
+
+        pagep = page_path(boardp, page)
+        mkd(pagep.parent)
+
+        digest = await write_doc(doc, pagep)
+
+        if not digest:
+            return None
+
+        digests.append(digest)
 
+    return digests[0] if len(digests) == 1 else pages_digest(digests)
+
+
+async def boards_index(indexp: Path, boards,
+                       updated: datetime) -> Optional[str]:
+    """
+    Index of the archived boards, dated with the archive's date
+    """
+    date = updated.strftime('%d-%m-%Y %I:%M %p')
 
-async def boards_index(indexp: Path, boards):
     doc, tag, text = Doc().tagtext()
     doc.asis('<!DOCTYPE html>')
 
@@ -358,7 +733,7 @@ async def boards_index(indexp: Path, boards):
                      rel='stylesheet',
                      href='style.css')
             with tag('title'):
-                text(f'Aether archive: {gendate}')
+                text(f'Aether archive: {date}')
 
         with tag('body'):
             with tag('h1'):
@@ -371,200 +746,501 @@ async def boards_index(indexp: Path, boards):
                             with tag('a', href=board.Fingerprint):
                                 text(board.Name)
 
-            footer(doc)
+            footer(doc, date)
 
     return await write_doc(doc, indexp)
 
 
-async def purrsist(args, cfg: dict) -> bool:
-    now = datetime.now(timezone.utc)
-    nowd = now.strftime('%d-%m-%Y')
+def feed_writers(dirp: Path, formats: List[str], title: str,
+                 updated: datetime,
+                 feed_id: str = PURRSIST_URL) -> List[FeedWriter]:
+    """
+    Writers for the atom.xml/rss.xml feeds in a directory
+    """
+    return [FeedWriter(dirp.joinpath(f'{fmt}.xml'), fmt, title,
+                       'Generated by aether-purrsist', updated,
+                       feed_id=feed_id)
+            for fmt in formats]
 
-    fg = FeedGenerator()
-    fg.id('https://gitlab.com/galacteek/aether-purrsist')
-    fg.language('en')
-    fg.title(f'Aether mirror feed ({nowd})')
-    fg.description('Generated by aether-purrsist')
-    fg.lastBuildDate(now)
-    fg.pubDate(now)
-    fg.link(href='.')
 
-    ipfscfg = cfg['ipfs']
-    feedscfg = cfg.get('feeds', {
-        'atom_generate': True,
-        'rss_generate': False
-    })
+def board_feed_id(board: BoardRecord) -> str:
+    return f'aether://board/{board.Fingerprint}'
 
-    client = aioipfs.AsyncIPFS(
-        maddr=ipfscfg.get('maddr', '/dns4/localhost/tcp/5001')
-    )
-    ipclient = ipfshttpclient.Client(
-        ipfscfg.get('maddr', '/dns4/localhost/tcp/5001')
+
+def thread_feed_entry(board: BoardRecord, thread: ThreadRecord) -> FeedEntry:
+    safeb = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', thread.Body)
+    html = mdrenderer.html(safeb)
+
+    return FeedEntry(
+        f'{board_feed_id(board)}/thread/{thread.Fingerprint}',
+        f'{board.Name}: {thread.Name}',
+        f'/{board.Fingerprint}/{thread.Fingerprint}',
+        thread.LocalArrival,
+        html if html is not None else safeb,
+        html=html is not None,
+        source=thread.Link if thread.Link else None
     )
 
+
+def add_progress(entry: dict) -> None:
+    """
+    Print an entry added to IPFS
+    """
+    name, cid, size = entry.get('Name'), entry.get('Hash'), entry.get('Size')
+
+    if cid:
+        print(f'Added {name}: {cid} ({size} bytes)')
+
+
+def write_report(cfg: dict, cid: Optional[str]) -> None:
+    """
+    Write the run's metrics (JSON report and/or Prometheus textfile),
+    if configured
+    """
+    metricscfg = cfg.get('metrics', {})
+
     try:
-        keys = await client.key.list()
-        kid, kn = None, ipfscfg.get('ipns_key', 'aether')
-    except aioipfs.APIError:
-        raise
+        metrics.write(json_path=metricscfg.get('json'),
+                      textfile_path=metricscfg.get('textfile'),
+                      cid=cid)
+    except Exception:
+        traceback.print_exc()
+
+
+async def board_date(board_fp: str) -> datetime:
+    """
+    Date of a board: the newest arrival (of a thread, post or vote) in
+    the board. The same contents always give the same pages and feeds.
+    """
+    threads, posts, _, votes = await db.marks(board_fp)
+
+    return max((sql_datetime(value) for value in (threads, posts, votes)
+                if value is not None),
+               default=datetime.fromtimestamp(0, timezone.utc))
+
+
+async def ipns_key(client: 'aioipfs.AsyncIPFS', name: str) -> str:
+    """
+    Id of the IPNS key with this name (the key is created if needed)
+    """
+    keys = await client.key.list()
 
     for k in keys['Keys']:
-        if k['Name'] == kn:
-            kid = k['Id']
+        if k['Name'] == name:
+            return k['Id']
 
-    if not kid:
-        resp = await client.key.gen(kn)
-        assert resp
+    resp = await client.key.gen(name)
+    assert resp
 
-        kid = resp['Id']
+    return resp['Id']
 
-    purr_ipfsp = f'/ipns/{kid}'
 
-    topd = Path(tempfile.mkdtemp(prefix='aetherp'))
-    dstd = topd.joinpath(kid)
+async def purrsist(args, cfg: dict,
+                   client: Optional['aioipfs.AsyncIPFS'] = None,
+                   kid: Optional[str] = None,
+                   prev: Optional[str] = None,
+                   workdir: Optional[Path] = None) -> Optional[str]:
+    """
+    Generate the archive, add it to IPFS and publish it. Returns the
+    CID of the archive.
 
-    boardsp = dstd.joinpath('boards')
-    atomfeedp = boardsp.joinpath('atom.xml')
-    rssfeedp = boardsp.joinpath('rss.xml')
+    The daemon passes its IPFS client and key id, the IPFS path of the
+    archive it published last (prev), and the directory where it keeps
+    the archive's files between the syncs (workdir). Otherwise the previous
+    archive is resolved from IPNS and fetched in a temporary directory.
+    """
+    metrics.reset()
+    profiler.stage('setup')
+
+    ipfscfg = cfg.get('ipfs', {})
+    cachecfg = cfg.get('cache', {})
+
+    identities.maxsize = cachecfg.get('identities_max', identities.maxsize)
+    mdrenderer.maxsize = cachecfg.get('markdown_max', mdrenderer.maxsize)
+
+    # Memory ceiling (RSS, in MiB), and number of threads read per query
+    memory_max = cachecfg.get('memory_max', 0) * 1024 * 1024
+    batch_size = cfg.get('db_batch_size', 500)
+
+    addcfg = ipfscfg.get('add', {})
+    add_opts = {
+        'chunker': addcfg.get('chunker'),
+        'raw_leaves': addcfg.get('raw_leaves', True),
+        'nocopy': addcfg.get('nocopy', False),
+        'only_hash': addcfg.get('only_hash', False)
+    }
+
+    # Output backend: filesystem, memory (--render-only), or ipfs (the files
+    # are generated in memory and streamed to IPFS)
+    backend = cfg.get('output', {}).get('backend', 'filesystem')
+
+    if backend not in ['filesystem', 'memory', 'ipfs']:
+        raise ValueError(f'Invalid output backend: {backend}')
+    elif backend == 'memory' and not args.render_only:
+        raise ValueError('The memory output can only be used with '
+                         '--render-only')
+    elif backend == 'ipfs' and not (args.car or args.render_only) and (
+            add_opts['nocopy'] or add_opts['only_hash']):
+        raise ValueError('The ipfs output can\'t be used with the nocopy '
+                         'and only_hash add options')
+
+    # The CAR export reads the archive from disk
+    output.configure(memory=backend != 'filesystem' and not args.car)
+
+    rendercfg = cfg.get('render', {})
+    workers = rendercfg.get('workers', 0)
+    pretty = rendercfg.get('pretty', True)
+    posts_per_page = rendercfg.get('posts_per_page', 0)
+    threads_per_page = rendercfg.get('threads_per_page', 0)
+    renderers = rendercfg.get('renderers', max(workers, 1))
+    queue_size = rendercfg.get('queue_size', renderers * 2)
+
+    feedscfg = cfg.get('feeds', {})
+    feeds_max = feedscfg.get('max_entries', 0)
+    feeds_boards = feedscfg.get('boards', True)
+    feeds_formats = [fmt for fmt, enabled in [
+        ('atom', feedscfg.get('atom_generate', True)),
+        ('rss', feedscfg.get('rss_generate', False))
+    ] if enabled]
+
+    # Close the client when done, unless it's the daemon's
+    own_client = client is None
+
+    if args.car or args.render_only:
+        # Offline export or rendering: no IPFS node is used and there's
+        # no previous archive, the whole archive is generated
+        client, kid = None, 'archive'
+    else:
+        # The IPFS modules are slow to import, they're only loaded when
+        # a node is used
+        import aioipfs
 
-    try:
-        await client.get(purr_ipfsp, dstdir=str(topd))
-        assert dstd.is_dir()
-    except AssertionError:
-        if dstd.is_file():
-            os.unlink(dstd)
-    except (Exception, aioipfs.APIError):
-        mkd(dstd)
+        if not client:
+            client = aioipfs.AsyncIPFS(
+                maddr=ipfscfg.get('maddr', '/dns4/localhost/tcp/5001')
+            )
+
+        if not kid:
+            kid = await ipns_key(client, ipfscfg.get('ipns_key', 'aether'))
+
+    purr_ipfsp = prev if prev else f'/ipns/{kid}'
+
+    # With the ipfs output, the files are always patched in MFS
+    direct = backend == 'ipfs' and client is not None
+    patch_mfs = (ipfscfg.get('mfs_patch', False) or direct) and \
+        client is not None
+
+    # The daemon's work directory is not used when patching in MFS,
+    # only the new files are written there
+    keep = workdir is not None and not patch_mfs
+    topd = workdir if keep else Path(tempfile.mkdtemp(prefix='aetherp'))
+
+    # The published archive is the boards directory itself, so the
+    # previous archive is fetched straight into it
+    boardsp = topd.joinpath(kid)
+    statep = boardsp.joinpath(STATE_FILENAME)
+
+    if patch_mfs:
+        from .mfs import mfs_resolve
+
+        # Only the previous archive's manifest is fetched, the new files
+        # will be patched into the previous tree in MFS
+        base = prev if prev else await mfs_resolve(client, purr_ipfsp)
+        mkd(boardsp)
+
+        if base:
+            try:
+                with metrics.timer('ipfs_fetch'):
+                    output.write(statep, await client.cat(
+                        f'{base}/{STATE_FILENAME}'))
+            except aioipfs.APIError:
+                pass
+    elif client and not (keep and boardsp.is_dir()):
+        try:
+            with metrics.timer('ipfs_fetch'):
+                await client.get(purr_ipfsp, dstdir=str(topd))
+
+            assert boardsp.is_dir()
+        except AssertionError:
+            if boardsp.is_file():
+                os.unlink(boardsp)
+        except (Exception, aioipfs.APIError):
+            pass
 
     mkd(boardsp)
 
-    shutil.copy(cssp, boardsp.joinpath('style.css'))
+    # State of the threads from the previous archive
+    tstates = state_load(statep) if not args.full else {}
 
-    acss = boardsp.joinpath('aether.css')
-    if acss.is_file():
-        acss.unlink()
+    for name, resource in STYLESHEETS.items():
+        cssp = boardsp.joinpath(name)
 
-    shutil.copy(aethcssp, acss)
+        if cssp.is_file():
+            cssp.unlink()
 
-    boards = [b async for b in boards_selection(cfg['boards'])]
-    vboards = []
+        output.write(cssp, resources.read_binary(__package__, resource))
 
-    for board, board_cfg in boards:
-        thr_processed = 0
-        max_threads = board_cfg.get('max_threads', 0)
-        thread_filter = board_cfg.get('threads_ignore_byname', [])
-        fingerprint = board_cfg.get('fingerprint',
-                                    board.Fingerprint)
+    mfsp = f'/aether-purrsist/{kid}'
 
-        boardp = boardsp.joinpath(board.Fingerprint)
+    if args.render_only:
+        uploader = None
+    else:
+        from . import mfs
+
+        if args.car:
+            uploader = mfs.CarUploader(boardsp, Path(args.car),
+                                       chunker=add_opts['chunker'],
+                                       raw_leaves=add_opts['raw_leaves'])
+        elif direct:
+            uploader = mfs.StreamUploader(
+                client, boardsp, mfsp,
+                base=base,
+                add_opts={'chunker': add_opts['chunker'],
+                          'raw_leaves': add_opts['raw_leaves']},
+                progress=add_progress if args.verbose > 1 else None
+            )
+        elif patch_mfs:
+            uploader = mfs.PatchUploader(client, boardsp, mfsp, base=base)
+        else:
+            uploader = mfs.TreeUploader(
+                client, boardsp, mfsp,
+                add_opts=add_opts,
+                progress=add_progress if args.verbose > 1 else None
+            )
 
-        mkd(boardp)
+    if uploader:
+        await uploader.start()
+
+    # Render the threads in a pool of processes if workers are configured
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=output.configure,
+        initargs=(output.memory, )
+    ) if workers > 0 else None
+
+    pipeline = Pipeline(
+        functools.partial(stream_thread, pretty=pretty,
+                          posts_per_page=posts_per_page),
+        tstates,
+        uploader=uploader,
+        executor=executor,
+        renderers=renderers,
+        queue_size=queue_size
+    )
+    pipeline.start()
 
-        thrs = await Threads.filter(Board=fingerprint).order_by(
-            '-LocalArrival')
+    try:
+        boards = [b async for b in boards_selection(cfg['boards'])]
+        vboards = []
+
+        # The boards are dated with their own contents (so that a board's
+        # feeds only change with the board), the archive with the newest board
+        bdates = {board.Fingerprint: await board_date(
+            board_cfg.get('fingerprint', board.Fingerprint))
+            for board, board_cfg in boards}
+        updated = max(bdates.values(),
+                      default=datetime.fromtimestamp(0, timezone.utc))
+        updatedd = updated.strftime('%d-%m-%Y')
+
+        # Feed of the newest threads of all the boards
+        gfeed = FeedSet(
+            feed_writers(boardsp, feeds_formats,
+                         f'Aether mirror feed ({updatedd})', updated),
+            max_entries=feeds_max,
+            ordered=False
+        )
+        gfeed.open()
+
+        for board, board_cfg in boards:
+            max_threads = board_cfg.get('max_threads', 0)
+            name_filter = NameFilter(
+                board_cfg.get('threads_ignore_byname', []))
+            fingerprint = board_cfg.get('fingerprint',
+                                        board.Fingerprint)
+
+            boardp = boardsp.joinpath(board.Fingerprint)
+
+            profiler.stage(f'board-{board.Fingerprint}')
+            mkd(boardp)
+
+            # Only the fingerprints, names and scores of the threads are kept
+            # for the board's index
+            index: List[ThreadIndexEntry] = []
+            bfeed: Optional[FeedSet] = None
+
+            async for batch in board_threads(fingerprint, max_threads,
+                                             name_filter,
+                                             batch_size=batch_size):
+                if bfeed is None:
+                    # First page of threads of the board
+                    if args.verbose > 0:
+                        print(f'Processing board: {board.Name} '
+                              f'({fingerprint})')
+
+                    # Feed of this board (the threads come newest first)
+                    bupdated = bdates[board.Fingerprint]
+                    bfeed = FeedSet(
+                        feed_writers(boardp,
+                                     feeds_formats if feeds_boards else [],
+                                     f'Aether mirror feed: {board.Name} '
+                                     f"({bupdated.strftime('%d-%m-%Y')})",
+                                     bupdated,
+                                     feed_id=board_feed_id(board)),
+                        max_entries=feeds_max
+                    )
+                    bfeed.open()
+
+                # The states and scores are only loaded for this page of
+                # threads (and their posts)
+                bstates = await board_threads_state(fingerprint, batch)
+                bscores = await db.scores(
+                    fingerprint, [thread.Fingerprint for thread in batch])
+
+                for thread in batch:
+                    index.append(ThreadIndexEntry(
+                        thread.Fingerprint, thread.Name,
+                        bscores.get(thread.Fingerprint, 0)))
+
+                    if memory_max and len(index) % 100 == 0 and \
+                            rss() > memory_max:
+                        # Above the memory ceiling: wait for the threads in
+                        # the pipeline, flush the board's files and empty
+                        # the caches
+                        await pipeline.flush(boardp)
+                        identities.clear(stats=False)
+                        mdrenderer.clear(stats=False)
+
+                        metrics.add('memory_ceiling', board=board.Fingerprint)
+
+                    threadp = boardp.joinpath(thread.Fingerprint)
+                    tstate = tstates.get(thread.Fingerprint)
+                    cur = bstates.get(thread.Fingerprint, {})
+
+                    if state_unchanged(tstate, cur) and (
+                            patch_mfs or
+                            output.exists(threadp.joinpath('index.html'))):
+                        if args.verbose > 1:
+                            print(f'Unchanged thread: {thread.Name}')
+
+                        metrics.add('threads', board=board.Fingerprint,
+                                    state='unchanged')
+                    else:
+                        if args.verbose > 1:
+                            print(f'Processing thread: {thread.Name}')
+
+                        mkd(threadp)
+
+                        with metrics.timer('thread_data',
+                                           board=board.Fingerprint):
+                            data = await thread_data(board, thread, bscores)
+
+                        metrics.add('threads', board=board.Fingerprint,
+                                    state='rendered')
+
+                        await pipeline.thread(
+                            board.Fingerprint, data, threadp,
+                            tstate.get('hash') if tstate else None, cur
+                        )
 
-        if len(thrs) == 0:
-            continue
+                    # Add an entry in the feeds for this thread
+                    if gfeed.wants(thread.LocalArrival) or \
+                            bfeed.wants(thread.LocalArrival):
+                        fentry = thread_feed_entry(board, thread)
 
-        if args.verbose > 0:
-            print(f'Processing board: {board.Name} ({fingerprint})')
+                        gfeed.add(fentry)
+                        bfeed.add(fentry)
 
-        for thread in thrs:
-            if any(re.compile(reg).search(thread.Name)
-                   for reg in thread_filter):
+            if bfeed is None:
+                # No threads to archive
                 continue
 
-            threadp = boardp.joinpath(thread.Fingerprint)
+            bfeed.close()
 
-            if args.verbose > 1:
-                print(f'Processing thread: {thread.Name}')
+            with metrics.timer('index', board=board.Fingerprint):
+                await board_threads_index(board, boardp, index,
+                                          threads_per_page=threads_per_page)
 
-            mkd(threadp)
+            pipeline.board_done(board.Fingerprint, boardp)
 
-            await purrsist_thread(
-                board, thread, threadp,
-                votes=await Votes.filter(
-                    Board=board.Fingerprint,
-                    Thread=thread.Fingerprint,
-                    Target=thread.Fingerprint
-                )
-            )
+            vboards.append(board)
 
-            thr_processed += 1
+            profiler.memory(board.Name)
 
-            # Add an entry in the feed for this thread
-            fe = fg.add_entry()
-            fe.id(
-                f'aether://board/{board.Fingerprint}'
-                f'/thread/{thread.Fingerprint}'
-            )
-            fe.title(f'{board.Name}: {thread.Name}')
-            fe.link(href=f'/{board.Fingerprint}/{thread.Fingerprint}')
-            fe.published(thread.LocalArrival)
-
-            # Set the entry's content
-            safeb = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', thread.Body)
-            if is_markdown(safeb):
-                fe.content(content=markdown.markdown(safeb))
-            else:
-                fe.content(content=safeb)
+        profiler.stage('finish')
+        await pipeline.join()
+    finally:
+        # Also when the sync fails (the daemon goes on with the next one):
+        # stop the stages and the render processes
+        await pipeline.stop()
 
-            if thread.Link:
-                fe.source(url=thread.Link)
+        if executor:
+            if sys.version_info >= (3, 9):
+                executor.shutdown(cancel_futures=True)
+            else:
+                executor.shutdown()
 
-            if max_threads > 0 and thr_processed >= max_threads:
-                break
+    await boards_index(boardsp.joinpath('index.html'), vboards, updated)
 
-        await board_threads_index(board, boardp, thrs)
+    state_save(statep, tstates, updated)
 
-        vboards.append(board)
+    if args.verbose > 0:
+        print(f'Identities cache: {identities.hits} hits, '
+              f'{identities.misses} misses')
+        print(f'Markdown cache: {mdrenderer.hits} hits, '
+              f'{mdrenderer.misses} misses')
 
-    await boards_index(boardsp.joinpath('index.html'), vboards)
+    for name, cache in [('identities', identities), ('markdown', mdrenderer)]:
+        metrics.add('cache_hits', cache.hits, cache=name)
+        metrics.add('cache_misses', cache.misses, cache=name)
 
-    # Generate the atom/rss feeds
-    if feedscfg['atom_generate']:
-        fg.atom_file(str(atomfeedp))
+    gfeed.close()
 
-    if feedscfg['rss_generate']:
-        fg.rss_file(str(rssfeedp))
+    if args.render_only:
+        # Nothing is added or published
+        output.take()
 
-    # the async add call is messed up so use the ipfshttpclient here
-    entries = ipclient.add(str(boardsp), cid_version=1, recursive=True)
+        if not keep:
+            shutil.rmtree(topd)
 
-    try:
-        pr_cfg = ipfscfg['pinremote']
-        entry = entries[-1]
-        cid = entry['Hash']
+        profiler.stop()
+        write_report(cfg, None)
+        return None
 
-        result = await client.name.publish(cid, key=kid)
-        assert result
+    with metrics.timer('ipfs_add', step='root'):
+        cid = await uploader.finish()
 
-        if pr_cfg['enabled']:
-            try:
-                await client.pin.remote.rm(
-                    pr_cfg['service'],
-                    name=pr_cfg['pin_name'],
-                    force=True
-                )
-            except aioipfs.APIError as e:
-                print(f'Failed to unpin from rps: {e.message}')
-
-            await asyncio.sleep(1)
-
-            await client.pin.remote.add(
-                pr_cfg['service'],
-                cid,
-                name=pr_cfg['pin_name']
-            )
+    profiler.stage('publish')
 
-            print(f'https://{cid}.ipfs.dweb.link')
+    if args.car or add_opts['only_hash']:
+        # Nothing was stored on the node, there's nothing to publish
+        if client and own_client:
+            await client.close()
 
-        await client.close()
-    except Exception as err:
-        raise err
-    else:
         print(cid)
 
-    shutil.rmtree(topd)
+        if not keep:
+            shutil.rmtree(topd)
 
-    return True
+        profiler.stop()
+        write_report(cfg, cid)
+        return cid
+
+    from .publish import publish
+
+    try:
+        await publish(client, cid, kid, ipfscfg)
+    finally:
+        if own_client:
+            await client.close()
+
+    print(cid)
+
+    if add_opts['nocopy'] and not patch_mfs:
+        # The filestore references the generated files, keep them
+        print(f'Archive files kept in {boardsp}')
+    elif not keep:
+        shutil.rmtree(topd)
+
+    profiler.stop()
+    write_report(cfg, cid)
+    return cid
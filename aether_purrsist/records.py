@@ -0,0 +1,81 @@
+"""
+Plain records of the rows that are archived, used by the rendering code
+(they're cheap to keep in memory and to send to the render workers).
+
+The fields of the database records are named after the columns, they're
+selected with values_list(*Record._fields).
+"""
+
+from datetime import datetime
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+
+class BoardRecord(NamedTuple):
+    """
+    The fields of a board that are needed to archive it
+    """
+
+    Fingerprint: str
+    Name: str
+    Owner: str
+
+
+class ThreadRecord(NamedTuple):
+    """
+    The fields of a thread that are needed to render it
+    """
+
+    Fingerprint: str
+    Owner: str
+    Name: str
+    Body: str
+    Link: str
+    LocalArrival: datetime
+
+
+class ThreadIndexEntry(NamedTuple):
+    """
+    The fields of a thread that are listed in the board's index
+    """
+
+    Fingerprint: str
+    Name: str
+    Score: int = 0
+
+
+class PostRecord(NamedTuple):
+    """
+    The fields of a post that are needed to render it
+    """
+
+    Fingerprint: str
+    Owner: str
+    Parent: str
+    Body: str
+    LocalArrival: datetime
+
+
+class IdentityRecord(NamedTuple):
+    Fingerprint: str
+    Name: str
+
+
+class ThreadData(NamedTuple):
+    """
+    Everything needed to render a thread's page, as plain records
+    (which can be sent to another process)
+    """
+
+    thread: ThreadRecord
+
+    # parent fingerprint -> replies
+    replies: Dict[str, List[PostRecord]]
+
+    # target fingerprint -> votes score
+    scores: Dict[str, int]
+
+    # owner fingerprint -> identity
+    owners: Dict[str, Optional[IdentityRecord]]
@@ -0,0 +1,65 @@
+import re
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Tuple
+
+from .records import BoardRecord
+
+
+class BoardsSelection:
+    """
+    The boards selected in the config. A board is selected by its
+    fingerprint (if the board's config has one), or by its name.
+
+    The name regexps are compiled once, each on its own (a regexp may
+    have inline flags, like (?i)), and must match the whole name. The
+    first matching entry of the config wins, as before.
+    """
+
+    def __init__(self, boards_cfg: dict):
+        self.cfgs: List[dict] = list(boards_cfg.values())
+        self.by_fp: Dict[str, int] = {}
+        self.names: List[Tuple[int, Pattern]] = []
+
+        for idx, (regex, bcfg) in enumerate(boards_cfg.items()):
+            fingerprint = bcfg.get('fingerprint')
+
+            if fingerprint:
+                self.by_fp.setdefault(fingerprint, idx)
+            else:
+                self.names.append((idx, re.compile(regex)))
+
+    def match(self, board: BoardRecord) -> Optional[dict]:
+        """
+        Config of the board, or None if the board isn't selected
+        """
+        matches = []
+
+        if board.Fingerprint in self.by_fp:
+            matches.append(self.by_fp[board.Fingerprint])
+
+        for idx, pattern in self.names:
+            if pattern.fullmatch(board.Name):
+                matches.append(idx)
+                break
+
+        return self.cfgs[min(matches)] if matches else None
+
+
+class NameFilter:
+    """
+    A list of regexps, compiled once (each on its own, as they may have
+    inline flags). A name is filtered if any of the regexps matches it.
+    """
+
+    def __init__(self, regexps: List[str]):
+        self.patterns: List[Pattern] = [re.compile(regex)
+                                        for regex in regexps]
+
+    def __bool__(self) -> bool:
+        return len(self.patterns) > 0
+
+    def filtered(self, name: str) -> bool:
+        return any(pattern.search(name) for pattern in self.patterns)
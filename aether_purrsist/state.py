@@ -0,0 +1,103 @@
+import json
+from datetime import datetime
+import traceback
+from pathlib import Path
+from typing import Dict
+from typing import List
+
+from .database import db
+from .output import output
+from .records import ThreadRecord
+
+
+# Name of the sync state manifest, stored at the root of the archive
+STATE_FILENAME = '.purrsist-state.json'
+
+# Bump this when the rendering of the thread pages changes, to
+# invalidate the state of previously archived threads
+STATE_VERSION = 2
+
+
+def state_load(path: Path) -> Dict[str, dict]:
+    """
+    Load the threads state from the manifest of the previous archive.
+    Returns an empty state if there's no (usable) manifest.
+    """
+    try:
+        manifest = json.loads(output.read(path))
+
+        if manifest.get('version') != STATE_VERSION:
+            return {}
+
+        return manifest.get('threads', {})
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        traceback.print_exc()
+        return {}
+
+
+def state_save(path: Path, threads: Dict[str, dict],
+               updated: datetime) -> None:
+    """
+    Write the manifest, with the archive's date
+    """
+    with output.open(path) as fd:
+        json.dump({
+            'version': STATE_VERSION,
+            'updated': updated.isoformat(),
+            'threads': threads
+        }, fd, sort_keys=True)
+
+
+def state_unchanged(prev: dict, cur: dict) -> bool:
+    """
+    Returns True if the current state of a thread matches the state
+    recorded in the manifest (the hash of the output is ignored)
+    """
+    return prev is not None and all(
+        prev.get(key) == value for key, value in cur.items()
+        if key != 'hash'
+    )
+
+
+async def board_threads_state(board_fp: str, threads: List[ThreadRecord]
+                              ) -> Dict[str, dict]:
+    """
+    Compute the state of these threads of a board (newest post arrival
+    and update, number of posts and votes) with one aggregate query
+    on the posts and one on the votes.
+    """
+    states: Dict[str, dict] = {}
+    thread_fps = [thread.Fingerprint for thread in threads]
+
+    for thread in threads:
+        arrival = thread.LocalArrival
+        states[thread.Fingerprint] = {
+            'arrival': arrival.isoformat() if arrival else None,
+            'posts_arrival': None,
+            'posts_update': None,
+            'posts': 0,
+            'votes_arrival': None,
+            'votes': 0
+        }
+
+    posts = await db.posts_state(board_fp, thread_fps)
+    votes = await db.votes_state(board_fp, thread_fps)
+
+    for thread_fp, arrival, update, count in posts:
+        if thread_fp in states:
+            states[thread_fp].update(
+                posts_arrival=arrival.isoformat() if arrival else None,
+                posts_update=update,
+                posts=count
+            )
+
+    for thread_fp, arrival, count in votes:
+        if thread_fp in states:
+            states[thread_fp].update(
+                votes_arrival=arrival.isoformat() if arrival else None,
+                votes=count
+            )
+
+    return states
@@ -0,0 +1,268 @@
+"""
+Synthetic Aether database generator, for benchmarks and for trying out
+aether-purrsist without the Aether app:
+
+    python -m aether_purrsist.synthdb --boards 5 --threads 200 synth.db
+
+The tables are created from the models, the contents are random but
+reproducible (seeded).
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import sqlite3
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from pathlib import Path
+from typing import Dict
+from typing import List
+
+from tortoise import Tortoise
+
+
+WORDS = [
+    'aether', 'archive', 'board', 'thread', 'post', 'peer', 'network',
+    'ipfs', 'node', 'content', 'free', 'open', 'source', 'linux', 'music',
+    'film', 'science', 'code', 'data', 'the', 'a', 'of', 'and', 'to', 'is',
+    'in', 'it', 'that', 'this', 'with', 'not', 'for', 'on', 'are', 'you'
+]
+
+LINKS = [
+    '', '', '', 'https://example.org/image.png',
+    'https://example.org/video.webm', 'https://example.org/article'
+]
+
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def fingerprint(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def timestamp(minutes: int) -> str:
+    # Same format as the ORM's datetime fields
+    return (EPOCH + timedelta(minutes=minutes)).isoformat(sep=' ')
+
+
+class BodyMaker:
+    """
+    Random texts, in markdown for a ratio of them
+    """
+
+    def __init__(self, rnd: random.Random, markdown_ratio: float):
+        self.rnd = rnd
+        self.markdown_ratio = markdown_ratio
+
+    def words(self, count: int) -> str:
+        return ' '.join(self.rnd.choice(WORDS) for _ in range(count))
+
+    def body(self) -> str:
+        rnd = self.rnd
+        paras = [self.words(rnd.randint(5, 60))
+                 for _ in range(rnd.randint(1, 4))]
+
+        if rnd.random() < self.markdown_ratio:
+            paras[0] = f'# {self.words(4)}\n\n' + paras[0]
+            paras.append(f'Some **{self.words(2)}**, see '
+                         f'[{self.words(2)}](https://example.org/) '
+                         f'and `{self.words(1)}`')
+
+        return '\n\n'.join(paras)
+
+
+async def create_schema(path: Path) -> None:
+    await Tortoise.init(
+        db_url=f'sqlite://{path}',
+        modules={'models': ['aether_purrsist.models']}
+    )
+
+    try:
+        await Tortoise.generate_schemas()
+    finally:
+        await Tortoise.close_connections()
+
+
+def insert(conn: sqlite3.Connection, table: str, rows: List[dict]) -> None:
+    if not rows:
+        return
+
+    cols = list(rows[0].keys())
+
+    conn.executemany(
+        f'INSERT INTO {table} ({", ".join(cols)}) '
+        f'VALUES ({", ".join("?" for col in cols)})',
+        [tuple(row[col] for col in cols) for row in rows]
+    )
+
+
+def base_row(fp: str, owner: str, arrival: int) -> dict:
+    return {
+        'EncrContent': '',
+        'Fingerprint': fp,
+        'LocalArrival': timestamp(arrival),
+        'LastReferenced': timestamp(arrival),
+        'Owner': owner,
+        'OwnerPublicKey': owner,
+        'Meta': '',
+        'RealmId': ''
+    }
+
+
+async def generate(path: Path,
+                   boards: int = 3,
+                   threads: int = 100,
+                   posts: int = 20,
+                   depth: int = 4,
+                   votes: int = 2,
+                   markdown_ratio: float = 0.3,
+                   users: int = 200,
+                   seed: int = 0) -> Dict[str, int]:
+    """
+    Write a synthetic database at path (which must not exist).
+
+    Each board has the given number of threads. The number of posts per
+    thread, and of votes per thread or post, vary randomly around the
+    given averages. Replies are nested up to depth levels.
+
+    Returns the number of rows of each table.
+    """
+    rnd = random.Random(seed)
+    bodies = BodyMaker(rnd, markdown_ratio)
+    counts = {'boards': 0, 'threads': 0, 'posts': 0, 'votes': 0,
+              'publickeys': 0}
+
+    await create_schema(path)
+
+    conn = sqlite3.connect(str(path))
+    owners = [fingerprint('user', idx) for idx in range(max(users, 1))]
+
+    # A few users don't have their key in the database
+    insert(conn, 'publickeys', [{
+        'Fingerprint': owner,
+        'Name': f'user{idx}',
+        'Type': 'ed25519',
+        'PublicKey': owner
+    } for idx, owner in enumerate(owners) if idx % 20 != 19])
+
+    clock = 0
+
+    for bidx in range(boards):
+        bfp = fingerprint('board', bidx)
+        trows, prows, vrows = [], [], []
+
+        insert(conn, 'boards', [dict(
+            base_row(bfp, rnd.choice(owners), bidx),
+            Name=f'Board{bidx}',
+            Description=bodies.words(10),
+            Creation=bidx,
+            Language='en'
+        )])
+
+        for tidx in range(threads):
+            tfp = fingerprint('thread', bidx, tidx)
+            clock += rnd.randint(1, 30)
+
+            trows.append(dict(
+                base_row(tfp, rnd.choice(owners), clock),
+                Board=bfp,
+                Body=bodies.body(),
+                Link=rnd.choice(LINKS),
+                Name=bodies.words(rnd.randint(2, 10)).capitalize()
+            ))
+
+            # (fingerprint, depth) of the objects that can be replied to
+            parents = [(tfp, 0)]
+
+            for pidx in range(rnd.randint(0, posts * 2)):
+                pfp = fingerprint('post', bidx, tidx, pidx)
+                parent, pdepth = rnd.choice(parents)
+                arrival = clock + rnd.randint(1, 10000)
+
+                prows.append(dict(
+                    base_row(pfp, rnd.choice(owners), arrival),
+                    Board=bfp,
+                    Thread=tfp,
+                    Parent=parent,
+                    Body=bodies.body(),
+                    Creation=arrival * 60,
+                    LastUpdate=arrival * 60
+                ))
+
+                if pdepth < depth:
+                    parents.append((pfp, pdepth + 1))
+
+            for target, _ in parents:
+                for vidx in range(rnd.randint(0, votes * 2)):
+                    vrows.append(dict(
+                        base_row(fingerprint('vote', target, vidx),
+                                 rnd.choice(owners),
+                                 clock + rnd.randint(1, 10000)),
+                        Board=bfp,
+                        Thread=tfp,
+                        Target=target,
+                        Type=rnd.choice([1, 1, 1, 2]),
+                        TypeClass=1
+                    ))
+
+        insert(conn, 'threads', trows)
+        insert(conn, 'posts', prows)
+        insert(conn, 'votes', vrows)
+        conn.commit()
+
+        counts['boards'] += 1
+        counts['threads'] += len(trows)
+        counts['posts'] += len(prows)
+        counts['votes'] += len(vrows)
+
+    counts['publickeys'] = conn.execute(
+        'SELECT COUNT(*) FROM publickeys').fetchone()[0]
+    conn.close()
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Aether database')
+    parser.add_argument('path', help='Path of the database to create')
+    parser.add_argument('--boards', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=100,
+                        help='Threads per board')
+    parser.add_argument('--posts', type=int, default=20,
+                        help='Average number of posts per thread')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='Maximum depth of the replies')
+    parser.add_argument('--votes', type=int, default=2,
+                        help='Average number of votes per thread or post')
+    parser.add_argument('--markdown-ratio', type=float, default=0.3,
+                        dest='markdown_ratio',
+                        help='Ratio of the texts that are in markdown')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = Path(args.path)
+
+    if path.exists():
+        parser.error(f'{path} already exists')
+
+    counts = asyncio.run(generate(
+        path,
+        boards=args.boards,
+        threads=args.threads,
+        posts=args.posts,
+        depth=args.depth,
+        votes=args.votes,
+        markdown_ratio=args.markdown_ratio,
+        users=args.users,
+        seed=args.seed
+    ))
+
+    print(', '.join(f'{count} {table}' for table, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
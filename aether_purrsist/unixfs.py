@@ -0,0 +1,371 @@
+import hashlib
+import struct
+from base64 import b32encode
+from pathlib import Path
+from typing import BinaryIO
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+
+# Multicodecs
+CODEC_RAW = 0x55
+CODEC_DAG_PB = 0x70
+MH_SHA2_256 = 0x12
+
+# UnixFS data types
+UNIXFS_DIRECTORY = 1
+UNIXFS_FILE = 2
+UNIXFS_HAMT_SHARD = 5
+
+# Same defaults as kubo: size-262144 chunker, balanced layout with 174 links
+# per node, directories sharded from 256KiB
+DEFAULT_CHUNK_SIZE = 262144
+MAX_LINKS = 174
+HAMT_FANOUT = 256
+HAMT_MURMUR3 = 0x22
+HAMT_SHARDING_SIZE = 262144
+
+U64 = 0xffffffffffffffff
+
+
+def varint(n: int) -> bytes:
+    buf = bytearray()
+
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+    buf.append(n)
+    return bytes(buf)
+
+
+def pb_varint(field: int, n: int) -> bytes:
+    return varint(field << 3) + varint(n)
+
+
+def pb_bytes(field: int, data: bytes) -> bytes:
+    return varint((field << 3) | 2) + varint(len(data)) + data
+
+
+def make_cid(codec: int, data: bytes) -> bytes:
+    """
+    CIDv1 (binary) of a block, with a sha2-256 multihash
+    """
+    return varint(1) + varint(codec) + \
+        bytes([MH_SHA2_256, 32]) + hashlib.sha256(data).digest()
+
+
+def cid_str(cid: bytes) -> str:
+    """
+    Base32 multibase string of a binary CIDv1
+    """
+    return 'b' + b32encode(cid).decode().lower().rstrip('=')
+
+
+def murmur3_64(data: bytes) -> bytes:
+    """
+    First 64 bits of the x64 128-bit murmur3 hash (seed 0), big-endian,
+    which is the hash function used by the UnixFS HAMT
+    """
+    c1, c2 = 0x87c37b91114253d5, 0x4cf5ad432745937f
+
+    def rotl(x: int, r: int) -> int:
+        return ((x << r) | (x >> (64 - r))) & U64
+
+    def fmix(k: int) -> int:
+        k ^= k >> 33
+        k = (k * 0xff51afd7ed558ccd) & U64
+        k ^= k >> 33
+        k = (k * 0xc4ceb9fe1a85ec53) & U64
+        return k ^ (k >> 33)
+
+    h1 = h2 = 0
+    nblocks = len(data) // 16
+
+    for i in range(nblocks):
+        k1, k2 = struct.unpack_from('<QQ', data, i * 16)
+
+        h1 ^= (rotl((k1 * c1) & U64, 31) * c2) & U64
+        h1 = (((rotl(h1, 27) + h2) & U64) * 5 + 0x52dce729) & U64
+
+        h2 ^= (rotl((k2 * c2) & U64, 33) * c1) & U64
+        h2 = (((rotl(h2, 31) + h1) & U64) * 5 + 0x38495ab5) & U64
+
+    tail = data[nblocks * 16:]
+
+    if len(tail) > 8:
+        k2 = int.from_bytes(tail[8:], 'little')
+        h2 ^= (rotl((k2 * c2) & U64, 33) * c1) & U64
+
+    if tail:
+        k1 = int.from_bytes(tail[:8], 'little')
+        h1 ^= (rotl((k1 * c1) & U64, 31) * c2) & U64
+
+    h1 ^= len(data)
+    h2 ^= len(data)
+    h1 = (h1 + h2) & U64
+    h2 = (h2 + h1) & U64
+    h1, h2 = fmix(h1), fmix(h2)
+    h1 = (h1 + h2) & U64
+
+    return h1.to_bytes(8, 'big')
+
+
+def unixfs_data(dtype: int,
+                data: Optional[bytes] = None,
+                filesize: Optional[int] = None,
+                blocksizes: List[int] = [],
+                hash_type: Optional[int] = None,
+                fanout: Optional[int] = None) -> bytes:
+    buf = pb_varint(1, dtype)
+
+    if data is not None:
+        buf += pb_bytes(2, data)
+
+    if filesize is not None:
+        buf += pb_varint(3, filesize)
+
+    for size in blocksizes:
+        buf += pb_varint(4, size)
+
+    if hash_type is not None:
+        buf += pb_varint(5, hash_type)
+
+    if fanout is not None:
+        buf += pb_varint(6, fanout)
+
+    return buf
+
+
+class Link(NamedTuple):
+    cid: bytes
+    name: str
+    tsize: int
+
+
+def dag_pb(links: List[Link], data: bytes) -> bytes:
+    """
+    Encode a dag-pb node. The links are sorted by name (stable sort),
+    and are serialized before the data.
+    """
+    buf = b''
+
+    for link in sorted(links, key=lambda lnk: lnk.name.encode()):
+        buf += pb_bytes(2, pb_bytes(1, link.cid) +
+                        pb_bytes(2, link.name.encode()) +
+                        pb_varint(3, link.tsize))
+
+    return buf + pb_bytes(1, data)
+
+
+class DagNode(NamedTuple):
+    cid: bytes
+
+    # Cumulative size of the DAG (as in the links' Tsize)
+    tsize: int
+
+    # Size of a file's contents
+    size: int = 0
+
+
+class CarWriter:
+    """
+    Writes blocks to a CARv1 file. Each block is written once.
+
+    The root isn't known until the whole DAG has been built, so the header
+    is written with a placeholder root, and rewritten when closing (CIDv1
+    sha2-256 CIDs all have the same length).
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.blocks: int = 0
+
+        self._fd: Optional[BinaryIO] = None
+        self._seen = set()
+
+    @staticmethod
+    def header(root: bytes) -> bytes:
+        # dag-cbor: {"roots": [root], "version": 1}
+        cidb = b'\x00' + root
+        hdr = b'\xa2\x65roots\x81\xd8\x2a' + \
+            b'\x58' + bytes([len(cidb)]) + cidb + \
+            b'\x67version\x01'
+        return varint(len(hdr)) + hdr
+
+    def open(self) -> None:
+        self._fd = open(self.path, 'wb')
+        self._fd.write(self.header(make_cid(CODEC_DAG_PB, b'')))
+
+    def put(self, cid: bytes, data: bytes) -> None:
+        if cid in self._seen:
+            return
+
+        self._fd.write(varint(len(cid) + len(data)) + cid + data)
+        self._seen.add(cid)
+        self.blocks += 1
+
+    def close(self, root: bytes) -> None:
+        self._fd.seek(0)
+        self._fd.write(self.header(root))
+        self._fd.close()
+        self._fd = None
+
+
+class ChunkReader:
+    def __init__(self, fd: BinaryIO, size: int):
+        self.fd = fd
+        self.size = size
+
+        self._next = fd.read(size)
+        self._first = True
+
+    @property
+    def done(self) -> bool:
+        return not self._first and not self._next
+
+    def read(self) -> bytes:
+        data = self._next
+
+        self._first = False
+        self._next = self.fd.read(self.size)
+        return data
+
+
+class DagBuilder:
+    """
+    Builds the UnixFS DAG of files and directories, the way
+    'ipfs add -r --cid-version 1' does with the default settings
+    (fixed-size chunker, balanced layout, basic or HAMT-sharded
+    directories), so that the CIDs match. The blocks are written
+    to a CarWriter.
+    """
+
+    def __init__(self, car: CarWriter,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 raw_leaves: bool = True):
+        self.car = car
+        self.chunk_size = chunk_size
+        self.raw_leaves = raw_leaves
+
+    def block(self, codec: int, data: bytes) -> bytes:
+        cid = make_cid(codec, data)
+        self.car.put(cid, data)
+        return cid
+
+    def node(self, links: List[Link], data: bytes) -> DagNode:
+        block = dag_pb(links, data)
+
+        return DagNode(self.block(CODEC_DAG_PB, block),
+                       len(block) + sum(link.tsize for link in links))
+
+    def leaf(self, data: bytes) -> DagNode:
+        if self.raw_leaves:
+            return DagNode(self.block(CODEC_RAW, data), len(data), len(data))
+
+        node = self.node([], unixfs_data(UNIXFS_FILE,
+                                         data=data if data else None,
+                                         filesize=len(data)))
+        return node._replace(size=len(data))
+
+    def file_node(self, children: List[DagNode]) -> DagNode:
+        size = sum(child.size for child in children)
+        node = self.node(
+            [Link(child.cid, '', child.tsize) for child in children],
+            unixfs_data(UNIXFS_FILE, filesize=size,
+                        blocksizes=[child.size for child in children])
+        )
+        return node._replace(size=size)
+
+    def fill(self, reader: ChunkReader, depth: int,
+             children: List[DagNode]) -> DagNode:
+        while len(children) < MAX_LINKS and not reader.done:
+            if depth == 1:
+                children.append(self.leaf(reader.read()))
+            else:
+                children.append(self.fill(reader, depth - 1, []))
+
+        return self.file_node(children)
+
+    def add_file(self, path: Path) -> DagNode:
+        with open(path, 'rb') as fd:
+            reader = ChunkReader(fd, self.chunk_size)
+            root = self.leaf(reader.read())
+            depth = 1
+
+            # Balanced layout: the tree gets one level deeper every time
+            # the root is full
+            while not reader.done:
+                root = self.fill(reader, depth, [root])
+                depth += 1
+
+            return root
+
+    def hamt(self, entries: List[Tuple[str, DagNode, bytes]],
+             depth: int = 0) -> DagNode:
+        slots: Dict[int, list] = {}
+
+        for entry in entries:
+            slots.setdefault(entry[2][depth], []).append(entry)
+
+        links, bitfield = [], 0
+
+        for idx in sorted(slots):
+            prefix = f'{idx:02X}'
+            bitfield |= 1 << idx
+
+            if len(slots[idx]) == 1:
+                name, node, _ = slots[idx][0]
+                links.append(Link(node.cid, prefix + name, node.tsize))
+            else:
+                shard = self.hamt(slots[idx], depth + 1)
+                links.append(Link(shard.cid, prefix, shard.tsize))
+
+        return self.node(links, unixfs_data(
+            UNIXFS_HAMT_SHARD,
+            data=bitfield.to_bytes((bitfield.bit_length() + 7) // 8, 'big'),
+            hash_type=HAMT_MURMUR3,
+            fanout=HAMT_FANOUT
+        ))
+
+    def directory(self, entries: List[Tuple[str, DagNode]]) -> DagNode:
+        estimate = sum(len(name.encode()) + len(node.cid)
+                       for name, node in entries)
+
+        # Like kubo, a directory is sharded when its estimate reaches the
+        # threshold, not only when it goes over
+        if estimate >= HAMT_SHARDING_SIZE:
+            return self.hamt([
+                (name, node, murmur3_64(name.encode()))
+                for name, node in entries
+            ])
+
+        return self.node(
+            [Link(node.cid, name, node.tsize) for name, node in entries],
+            unixfs_data(UNIXFS_DIRECTORY)
+        )
+
+    def add_dir(self, path: Path,
+                done: Dict[Path, DagNode] = {}) -> DagNode:
+        """
+        Add a directory recursively (including the dot files). The
+        subdirectories found in done have already been added.
+        """
+        entries = []
+
+        for child in sorted(path.iterdir()):
+            if child in done:
+                node = done[child]
+            elif child.is_dir():
+                node = self.add_dir(child, done)
+            elif child.is_file():
+                node = self.add_file(child)
+            else:
+                continue
+
+            entries.append((child.name, node))
+
+        return self.directory(entries)
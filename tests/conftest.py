@@ -0,0 +1,67 @@
+import socket
+from typing import Awaitable
+from typing import Callable
+from typing import List
+
+import aioipfs
+from aiohttp import web
+
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def api_error(message: str, status: int = 500) -> web.Response:
+    """
+    Error response of the kubo API
+    """
+    return web.json_response(
+        {'Message': message, 'Code': 0, 'Type': 'error'}, status=status)
+
+
+class FakeKubo:
+    """
+    Fake kubo RPC API: an aiohttp server with a handler for each endpoint
+    (as in /api/v0/<endpoint>). The endpoints that are called are recorded
+    in calls (with their query), and client is an aioipfs client of the
+    server.
+
+        async with FakeKubo({'name/publish': handler}) as kubo:
+            await kubo.client.name.publish(...)
+    """
+
+    def __init__(self, handlers: dict):
+        self.calls: List[tuple] = []
+        self.app = web.Application()
+        self.port = free_port()
+
+        for endpoint, handler in handlers.items():
+            self.app.router.add_post(f'/api/v0/{endpoint}',
+                                     self.recorded(endpoint, handler))
+
+    def recorded(self, endpoint: str, handler: Handler) -> Handler:
+        async def record(request: web.Request) -> web.StreamResponse:
+            self.calls.append((endpoint, request.query))
+            return await handler(request)
+
+        return record
+
+    def called(self, endpoint: str) -> list:
+        return [query for name, query in self.calls if name == endpoint]
+
+    async def __aenter__(self) -> 'FakeKubo':
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+        self.client = aioipfs.AsyncIPFS(host='127.0.0.1', port=self.port)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.client.close()
+        await self.runner.cleanup()
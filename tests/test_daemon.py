@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import multiprocessing
+import sqlite3
+
+from aether_purrsist.daemon import Daemon
+from aether_purrsist.database import db
+from aether_purrsist.synthdb import generate
+
+
+CFG = {
+    'boards': {'.*': {}},
+    'render': {'workers': 2},
+    'output': {'backend': 'filesystem'}
+}
+
+
+def test_sync_error(tmp_path, monkeypatch):
+    dbpath = tmp_path.joinpath('synth.db')
+    workdir = tmp_path.joinpath('work')
+    workdir.mkdir()
+
+    scores = db.scores
+    calls = 0
+
+    async def locked_scores(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+
+        # The threads of the first board are in the pipeline by now
+        if calls == 2:
+            raise sqlite3.OperationalError('database is locked')
+
+        return await scores(*args, **kwargs)
+
+    async def run():
+        await generate(dbpath, boards=2, threads=5, posts=3)
+        await db.open(dbpath, raw=True)
+
+        try:
+            daemon = Daemon(argparse.Namespace(
+                full=False, car=None, render_only=True, verbose=0),
+                CFG, interval=1)
+
+            monkeypatch.setattr(db, 'scores', locked_scores)
+
+            failed = False
+
+            try:
+                await daemon.sync(workdir)
+            except sqlite3.OperationalError:
+                failed = True
+
+            # The pipeline's stages are stopped
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            marks = daemon.marks
+
+            # The next sync starts over
+            monkeypatch.setattr(db, 'scores', scores)
+            await daemon.sync(workdir)
+
+            return failed, tasks, marks, daemon.marks
+        finally:
+            await db.close()
+
+    failed, tasks, marks, synced = asyncio.run(run())
+
+    assert failed
+    assert tasks == set()
+    assert marks is None
+    assert synced is not None
+    assert workdir.joinpath('archive', 'index.html').is_file()
+    # The render processes are shut down
+    assert multiprocessing.active_children() == []
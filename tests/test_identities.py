@@ -0,0 +1,36 @@
+import asyncio
+
+from aether_purrsist import identities as identities_mod
+from aether_purrsist.identities import IdentityCache
+from aether_purrsist.records import IdentityRecord
+
+
+def test_preload_counters(monkeypatch):
+    queries = []
+
+    async def db_identities(fingerprints):
+        queries.append(sorted(fingerprints))
+        return [IdentityRecord(fp, fp.upper()) for fp in fingerprints
+                if fp != 'unknown']
+
+    monkeypatch.setattr(identities_mod.db, 'identities', db_identities)
+
+    async def run():
+        cache = IdentityCache()
+        first = await cache.preload(['a', 'b', 'unknown', 'a'])
+        counts = (cache.hits, cache.misses)
+        second = await cache.preload(['a', 'c'])
+
+        return cache, first, counts, second
+
+    cache, first, counts, second = asyncio.run(run())
+
+    assert first == {'a': IdentityRecord('a', 'A'),
+                     'b': IdentityRecord('b', 'B'),
+                     'unknown': None}
+    assert counts == (0, 3)
+    assert second == {'a': IdentityRecord('a', 'A'),
+                      'c': IdentityRecord('c', 'C')}
+    assert (cache.hits, cache.misses) == (1, 4)
+    # Only the uncached fingerprints are queried
+    assert queries == [['a', 'b', 'unknown'], ['c']]
@@ -0,0 +1,16 @@
+from aether_purrsist.metrics import Metrics
+
+
+def test_textfile_counters():
+    metrics = Metrics()
+    metrics.add('bytes_written', 1221370, board='b"1')
+    metrics.add('ratio', 0.1234567891)
+    metrics.observe('render', 0.5)
+    metrics.observe('render', 0.25)
+
+    lines = metrics.textfile().splitlines()
+
+    assert 'purrsist_bytes_written_total{board="b\\"1"} 1221370' in lines
+    assert 'purrsist_ratio_total 0.1234567891' in lines
+    assert 'purrsist_render_seconds_sum 0.750000' in lines
+    assert 'purrsist_render_seconds_count 2' in lines
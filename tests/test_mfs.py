@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict
+from urllib.parse import unquote
+
+import aioipfs
+import pytest
+from aiohttp import web
+
+from aether_purrsist.mfs import PatchUploader
+from aether_purrsist.mfs import StreamUploader
+from aether_purrsist.output import output
+
+from conftest import FakeKubo
+from conftest import api_error
+
+
+# Tree of the previous archive
+BASE = {
+    'index.html': b'root v1',
+    'board/index.html': b'board v1',
+    'board/page/2.html': b'board page 2 v1',
+    'board/page/3.html': b'board page 3 v1',
+    'board/thread1/index.html': b'thread1 v1',
+    'board/thread2/index.html': b'thread2 v1',
+    'board/thread2/page/2.html': b'thread2 page 2 v1'
+}
+
+
+class FakeMFS:
+    """
+    MFS of the fake node (files only, the directories are implicit). The
+    previous archive is at /ipfs/bafybase.
+    """
+
+    def __init__(self, add_failures: int = 0):
+        self.files: Dict[str, bytes] = {}
+
+        # Added trees (cid -> relative path -> contents), the base is the
+        # previous archive
+        self.trees: Dict[str, Dict[str, bytes]] = {'bafybase': BASE}
+        self.add_failures = add_failures
+
+    def under(self, path: str) -> list:
+        return [fpath for fpath in self.files
+                if fpath == path or fpath.startswith(path + '/')]
+
+    async def rm(self, request: web.Request) -> web.Response:
+        paths = self.under(request.query['arg'])
+
+        if not paths:
+            return api_error('file does not exist')
+
+        for fpath in paths:
+            del self.files[fpath]
+
+        return web.Response(text='')
+
+    async def cp(self, request: web.Request) -> web.Response:
+        src, dst = request.query.getall('arg')
+        tree = self.trees[src[len('/ipfs/'):]]
+
+        self.files.update({f'{dst}/{name}'.rstrip('/'): data
+                           for name, data in tree.items()})
+        return web.Response(text='')
+
+    async def add(self, request: web.Request) -> web.Response:
+        if self.add_failures > 0:
+            self.add_failures -= 1
+            return api_error('add failed')
+
+        reader = await request.multipart()
+        names, files = [], {}
+
+        async for part in reader:
+            # The names are escaped by aiohttp (and unescaped by kubo)
+            name = unquote(part.filename)
+            names.append(name)
+
+            if part.headers['Content-Type'] != 'application/x-directory':
+                files[name] = await part.read()
+
+        entries = []
+
+        for name in names:
+            tree = {fname[len(name) + 1:]: data
+                    for fname, data in files.items()
+                    if fname.startswith(name + '/')}
+
+            if name in files:
+                tree = {'': files[name]}
+
+            cid = 'bafy' + hashlib.sha256(json.dumps(sorted(
+                (path, data.decode()) for path, data in tree.items()
+            )).encode()).hexdigest()[:16]
+
+            self.trees[cid] = tree
+            entries.append(json.dumps({'Name': name, 'Hash': cid}) + '\n')
+
+        return web.Response(text=''.join(entries))
+
+    async def write(self, request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        part = await reader.next()
+
+        self.files[request.query['arg']] = await part.read()
+        return web.Response(text='')
+
+    async def ok(self, request: web.Request) -> web.Response:
+        return web.Response(text='')
+
+    def root_cid(self) -> str:
+        digest = hashlib.sha256(json.dumps(sorted(
+            (path, data.decode()) for path, data in self.files.items()
+        )).encode()).hexdigest()
+
+        return f'bafy{digest[:16]}'
+
+    async def stat(self, request: web.Request) -> web.Response:
+        return web.json_response({'Hash': self.root_cid()})
+
+    def handlers(self) -> dict:
+        return {'add': self.add,
+                'files/rm': self.rm,
+                'files/cp': self.cp,
+                'files/mkdir': self.ok,
+                'files/write': self.write,
+                'files/flush': self.ok,
+                'files/stat': self.stat}
+
+
+def write_tree(rootp: Path, files: Dict[str, bytes]) -> None:
+    for name, data in files.items():
+        rootp.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        rootp.joinpath(name).write_bytes(data)
+
+
+def test_patch_uploader(tmp_path):
+    mfs = FakeMFS()
+    rootp = tmp_path.joinpath('archive')
+
+    # thread1 is unchanged (not regenerated), thread2 and the board's
+    # index have fewer pages
+    write_tree(rootp, {
+        'index.html': b'root v2',
+        'board/index.html': b'board v2',
+        'board/page/2.html': b'board page 2 v2',
+        'board/thread2/index.html': b'thread2 v2'
+    })
+
+    async def run():
+        async with FakeKubo(mfs.handlers()) as kubo:
+            uploader = PatchUploader(kubo.client, rootp, '/purrsist/key',
+                                     base='/ipfs/bafybase')
+            await uploader.start()
+            await uploader.subtree(rootp.joinpath('board'))
+            cid = await uploader.finish()
+
+            return cid, [name for name, query in kubo.calls]
+
+    cid, calls = asyncio.run(run())
+    files = {path[len('/purrsist/key/'):]: data
+             for path, data in mfs.files.items()}
+
+    assert files == {
+        'index.html': b'root v2',
+        'board/index.html': b'board v2',
+        'board/page/2.html': b'board page 2 v2',
+        'board/thread1/index.html': b'thread1 v1',
+        'board/thread2/index.html': b'thread2 v2'
+    }
+
+    # The previous archive is linked, patched, and the root is flushed
+    assert calls[:2] == ['files/rm', 'files/cp']
+    assert calls[-2:] == ['files/flush', 'files/stat']
+    assert calls.count('files/write') == 4
+    assert cid == mfs.root_cid()
+
+
+def test_stream_uploader_retry(tmp_path):
+    mfs = FakeMFS(add_failures=1)
+    rootp = tmp_path.joinpath('archive')
+    boardp = rootp.joinpath('board')
+    new = {
+        'index.html': b'root v2',
+        'board/index.html': b'board v2',
+        'board/thread2/index.html': b'thread2 v2'
+    }
+
+    # thread1 is unchanged, thread2 is replaced
+    async def run():
+        async with FakeKubo(mfs.handlers()) as kubo:
+            uploader = StreamUploader(kubo.client, rootp, '/purrsist/key',
+                                      base='/ipfs/bafybase')
+            await uploader.start()
+
+            with pytest.raises(aioipfs.APIError):
+                await uploader.subtree(boardp)
+
+            # The board's files are kept until they're uploaded
+            kept = set(output.under(boardp))
+
+            return kept, await uploader.finish()
+
+    output.configure(memory=True)
+
+    try:
+        for name, data in new.items():
+            output.write(rootp.joinpath(name), data)
+
+        kept, cid = asyncio.run(run())
+        left = output.under()
+    finally:
+        output.configure()
+
+    files = {path[len('/purrsist/key/'):]: data
+             for path, data in mfs.files.items()}
+
+    assert kept == {boardp.joinpath('index.html'),
+                    boardp.joinpath('thread2', 'index.html')}
+    assert left == {}
+    assert files == {
+        'index.html': b'root v2',
+        'board/index.html': b'board v2',
+        'board/thread1/index.html': b'thread1 v1',
+        'board/thread2/index.html': b'thread2 v2'
+    }
+    assert cid == mfs.root_cid()
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+
+import pytest
+
+from aether_purrsist.pipeline import Pipeline
+from aether_purrsist.records import ThreadData
+from aether_purrsist.records import ThreadRecord
+
+
+class FailingUploader:
+    """
+    Uploader failing on the boards in fail
+    """
+
+    def __init__(self, fail: set):
+        self.fail = fail
+        self.uploaded = []
+
+    async def subtree(self, path: Path) -> None:
+        if path.name in self.fail:
+            raise RuntimeError(f'{path.name}: add failed')
+
+        self.uploaded.append(path.name)
+
+
+def thread_data(thread_fp: str) -> ThreadData:
+    return ThreadData(
+        ThreadRecord(thread_fp, 'owner', thread_fp, '', '',
+                     datetime(2023, 1, 1, tzinfo=timezone.utc)),
+        {}, {}, {})
+
+
+def test_upload_error(tmp_path):
+    uploader = FailingUploader({'board1'})
+    tstates = {}
+
+    async def run():
+        pipeline = Pipeline(lambda data, path, digest: 'digest', tstates,
+                            uploader=uploader)
+        pipeline.start()
+
+        for board_fp in ['board1', 'board2']:
+            boardp = tmp_path.joinpath(board_fp)
+            thread_fp = f'{board_fp}-thread'
+
+            await pipeline.thread(board_fp, thread_data(thread_fp),
+                                  boardp.joinpath(thread_fp), None, {})
+            pipeline.board_done(board_fp, boardp)
+
+        try:
+            await pipeline.join()
+        finally:
+            assert all(task.done() for task in pipeline._tasks)
+
+    with pytest.raises(RuntimeError, match='board1: add failed'):
+        asyncio.run(run())
+
+    # The next boards are still uploaded
+    assert uploader.uploaded == ['board2']
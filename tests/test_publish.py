@@ -0,0 +1,179 @@
+import asyncio
+import json
+
+import aioipfs
+import pytest
+from aiohttp import web
+
+from aether_purrsist.publish import ipns_publish
+from aether_purrsist.publish import pin_remote
+from aether_purrsist.publish import publish
+
+from conftest import FakeKubo
+from conftest import api_error
+from conftest import free_port
+
+
+PUBCFG = {'lifetime': '48h', 'ttl': '5m', 'retries': 2, 'timeout': 5,
+          'retry_delay': 0}
+PRCFG = {'enabled': True, 'service': 'svc', 'pin_name': 'mirror',
+         'poll_interval': 0, 'timeout': 5, 'retry_delay': 0}
+
+
+class PinService:
+    """
+    Remote pinning service of the fake node. The status of an added pin
+    goes through statuses, one step each time it's listed.
+    """
+
+    def __init__(self, pins: list, statuses: list):
+        self.pins = pins
+        self.statuses = statuses
+
+    async def ls(self, request: web.Request) -> web.Response:
+        cids = request.query.getall('cid', [])
+        name = request.query.get('name')
+        pins = [pin for pin in self.pins
+                if (not cids or pin['Cid'] in cids) and
+                (not name or pin['Name'] == name)]
+
+        for pin in pins:
+            if pin.get('steps'):
+                pin['Status'] = pin['steps'].pop(0)
+
+        return web.Response(text=''.join(
+            json.dumps({key: pin[key] for key in ('Cid', 'Name', 'Status')})
+            + '\n' for pin in pins))
+
+    async def add(self, request: web.Request) -> web.Response:
+        pin = {'Cid': request.query['arg'], 'Name': request.query['name'],
+               'Status': 'queued', 'steps': list(self.statuses)}
+        self.pins.append(pin)
+
+        return web.json_response({'Cid': pin['Cid'], 'Name': pin['Name'],
+                                  'Status': 'queued'})
+
+    async def rm(self, request: web.Request) -> web.Response:
+        cids = request.query.getall('cid')
+        self.pins[:] = [pin for pin in self.pins if pin['Cid'] not in cids]
+
+        return web.Response(text='')
+
+    def handlers(self) -> dict:
+        return {'pin/remote/ls': self.ls,
+                'pin/remote/add': self.add,
+                'pin/remote/rm': self.rm}
+
+
+def published(failures: int = 0, delay: float = 0):
+    """
+    name/publish handler, failing failures times first
+    """
+    async def handler(request: web.Request) -> web.Response:
+        nonlocal failures
+
+        await asyncio.sleep(delay)
+
+        if failures > 0:
+            failures -= 1
+            return api_error('routing: not found')
+
+        return web.json_response({'Name': request.query['key'],
+                                  'Value': request.query['arg']})
+
+    return handler
+
+
+def test_ipns_publish_retried():
+    async def run():
+        async with FakeKubo({'name/publish': published(1)}) as kubo:
+            result = await ipns_publish(kubo.client, 'bafynew', 'k51key',
+                                        PUBCFG)
+            return result, kubo.called('name/publish')
+
+    result, calls = asyncio.run(run())
+
+    assert result == {'Name': 'k51key', 'Value': '/ipfs/bafynew'}
+    assert len(calls) == 2
+    assert calls[-1]['lifetime'] == '48h'
+    assert calls[-1]['ttl'] == '5m'
+    assert calls[-1]['allow-offline'] == 'false'
+
+
+def test_ipns_publish_timeout():
+    async def run():
+        async with FakeKubo({'name/publish': published(delay=1)}) as kubo:
+            with pytest.raises(aioipfs.APIError):
+                await ipns_publish(kubo.client, 'bafynew', 'k51key',
+                                   dict(PUBCFG, timeout=0.2))
+
+            return kubo.called('name/publish')
+
+    assert len(asyncio.run(run())) == 3
+
+
+def test_ipns_publish_no_node():
+    async def run():
+        client = aioipfs.AsyncIPFS(host='127.0.0.1', port=free_port())
+
+        try:
+            await publish(client, 'bafynew', 'k51key',
+                          {'publish': dict(PUBCFG, retries=0)})
+        finally:
+            await client.close()
+
+    with pytest.raises(aioipfs.APIError):
+        asyncio.run(run())
+
+
+def test_pin_remote_replaces():
+    service = PinService(
+        [{'Cid': 'bafyold', 'Name': 'mirror', 'Status': 'pinned'}],
+        ['queued', 'pinning', 'pinned'])
+
+    async def run():
+        async with FakeKubo(service.handlers()) as kubo:
+            assert await pin_remote(kubo.client, 'bafynew', PRCFG)
+            return [name for name, query in kubo.calls]
+
+    calls = asyncio.run(run())
+
+    # Added, polled until it's pinned, then the old pin is removed
+    assert calls == ['pin/remote/ls', 'pin/remote/add', 'pin/remote/ls',
+                     'pin/remote/ls', 'pin/remote/ls', 'pin/remote/rm']
+    assert [(pin['Cid'], pin['Status']) for pin in service.pins] == [
+        ('bafynew', 'pinned')]
+
+
+@pytest.mark.parametrize('statuses, timeout', [
+    (['queued'] * 1000, 0.2),
+    (['queued', 'failed'], 5)
+])
+def test_pin_remote_keeps_old(statuses, timeout):
+    service = PinService(
+        [{'Cid': 'bafyold', 'Name': 'mirror', 'Status': 'pinned'}],
+        statuses)
+
+    async def run():
+        async with FakeKubo(service.handlers()) as kubo:
+            assert not await pin_remote(
+                kubo.client, 'bafynew',
+                dict(PRCFG, timeout=timeout, poll_interval=0.01))
+            return kubo.called('pin/remote/rm')
+
+    assert asyncio.run(run()) == []
+    assert 'bafyold' in [pin['Cid'] for pin in service.pins]
+
+
+def test_publish_concurrent():
+    service = PinService([], ['pinned'])
+    handlers = dict(service.handlers(), **{'name/publish': published()})
+
+    async def run():
+        async with FakeKubo(handlers) as kubo:
+            await publish(kubo.client, 'bafynew', 'k51key',
+                          {'publish': PUBCFG, 'pinremote': PRCFG})
+            return kubo.called('name/publish')
+
+    assert len(asyncio.run(run())) == 1
+    assert [pin['Cid'] for pin in service.pins] == ['bafynew']
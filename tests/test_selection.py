@@ -0,0 +1,44 @@
+import pytest
+
+from aether_purrsist.records import BoardRecord
+from aether_purrsist.selection import BoardsSelection
+from aether_purrsist.selection import NameFilter
+
+
+def board(name: str, fingerprint: str = 'fp') -> BoardRecord:
+    return BoardRecord(fingerprint, name, 'owner')
+
+
+@pytest.mark.parametrize('name, filtered', [
+    ('Dead thread', True),
+    ('DEAD', True),
+    ('buy spam', True),
+    ('Buy SPAM', False),
+    ('Hello', False)
+])
+def test_name_filter(name, filtered):
+    # Inline flags are local to their regexp
+    assert NameFilter(['(?i)dead', 'spam']).filtered(name) is filtered
+
+
+def test_name_filter_empty():
+    assert not NameFilter([])
+    assert not NameFilter([]).filtered('anything')
+
+
+def test_boards_selection():
+    first, second, third = {'max_threads': 1}, {}, {'fingerprint': 'fp3'}
+    selection = BoardsSelection({
+        '(?i)aether.*': first,
+        'Aether Dev|Meta': second,
+        'ignored': third
+    })
+
+    assert selection.match(board('AETHER talk')) is first
+    # The first matching entry wins
+    assert selection.match(board('Aether Dev')) is first
+    assert selection.match(board('Meta')) is second
+    # The whole name must match
+    assert selection.match(board('Meta stuff')) is None
+    assert selection.match(board('ignored')) is None
+    assert selection.match(board('Other', 'fp3')) is third
@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+from aether_purrsist.bench import ENTRYPOINT
+from aether_purrsist.bench import import_time
+
+
+# Import time budget of the command's module, in milliseconds (it's
+# about 200ms, it was 800ms when everything was imported at startup)
+IMPORT_BUDGET_MS = 400
+
+# Modules that must only be imported when they're used
+LAZY_MODULES = ['aioipfs', 'aiohttp', 'tortoise', 'markdown',
+                'pkg_resources']
+
+
+def test_import_budget():
+    # The best of two runs (the first one may compile the modules)
+    usecs = min(import_time()[ENTRYPOINT] for run in range(2))
+
+    assert usecs / 1000 <= IMPORT_BUDGET_MS
+
+
+def test_lazy_imports():
+    proc = subprocess.run(
+        [sys.executable, '-c',
+         f'import sys, {ENTRYPOINT}; '
+         f'print(*[name for name in {LAZY_MODULES!r} '
+         f'if name in sys.modules])'],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+    assert proc.stdout.split() == []
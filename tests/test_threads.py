@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from aether_purrsist.database import db
+from aether_purrsist.purrsist import board_threads
+from aether_purrsist.selection import NameFilter
+from aether_purrsist.synthdb import generate
+
+
+@pytest.mark.parametrize('max_threads, name_filter, batch_size, fetched', [
+    # Only the missing threads are read
+    (7, [], 500, [7]),
+    (7, [], 5, [5, 2]),
+    # Twice as many with name filters (nothing is filtered here)
+    (7, ['^$'], 500, [14]),
+    # Every thread is filtered: all the pages are read
+    (7, ['.*'], 10, [10, 10, 0]),
+    (0, [], 500, [20])
+])
+def test_board_threads_fetched(tmp_path, monkeypatch, max_threads,
+                               name_filter, batch_size, fetched):
+    dbpath = tmp_path.joinpath('synth.db')
+    threads_page = db.threads_page
+    pages = []
+
+    async def recorded_page(*args, **kwargs):
+        records, after = await threads_page(*args, **kwargs)
+        pages.append(len(records))
+
+        return records, after
+
+    monkeypatch.setattr(db, 'threads_page', recorded_page)
+
+    async def run():
+        await generate(dbpath, boards=1, threads=20, posts=1)
+        await db.open(dbpath, raw=True)
+
+        try:
+            board = (await db.boards())[0]
+
+            return [thread async for batch in board_threads(
+                board.Fingerprint, max_threads, NameFilter(name_filter),
+                batch_size=batch_size) for thread in batch]
+        finally:
+            await db.close()
+
+    threads = asyncio.run(run())
+    expected = 0 if name_filter == ['.*'] else max_threads or 20
+
+    assert pages == fetched
+    assert len(threads) == expected
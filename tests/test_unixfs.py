@@ -0,0 +1,347 @@
+import hashlib
+from pathlib import Path
+from typing import Dict
+from typing import Tuple
+
+import pytest
+
+from aether_purrsist import unixfs
+from aether_purrsist.unixfs import CarWriter
+from aether_purrsist.unixfs import DagBuilder
+from aether_purrsist.unixfs import cid_str
+from aether_purrsist.unixfs import murmur3_64
+
+
+def read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+
+    while True:
+        byte = data[pos]
+        n |= (byte & 0x7f) << shift
+        pos += 1
+        shift += 7
+
+        if byte < 0x80:
+            return n, pos
+
+
+def pb_fields(data: bytes) -> list:
+    """
+    (field, value) of a protobuf message (bytes or int values)
+    """
+    fields, pos = [], 0
+
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+
+        if key & 7 == 2:
+            size, pos = read_varint(data, pos)
+            fields.append((key >> 3, data[pos:pos + size]))
+            pos += size
+        else:
+            value, pos = read_varint(data, pos)
+            fields.append((key >> 3, value))
+
+    return fields
+
+
+def decode_node(block: bytes) -> dict:
+    """
+    dag-pb node, with its UnixFS data decoded
+    """
+    links, udata = [], b''
+
+    for field, value in pb_fields(block):
+        if field == 2:
+            link = dict(pb_fields(value))
+            links.append((link[1], link.get(2, b'').decode(), link[3]))
+        elif field == 1:
+            udata = value
+
+    node = {'links': links, 'blocksizes': []}
+
+    for field, value in pb_fields(udata):
+        if field == 4:
+            node['blocksizes'].append(value)
+        else:
+            node[{1: 'type', 2: 'data', 3: 'filesize', 5: 'hash_type',
+                  6: 'fanout'}[field]] = value
+
+    return node
+
+
+def read_car(path: Path) -> Tuple[bytes, Dict[bytes, bytes]]:
+    """
+    Root and blocks of a CARv1 file (the CIDs are checked)
+    """
+    data = path.read_bytes()
+    size, pos = read_varint(data, 0)
+    header = data[pos:pos + size]
+    pos += size
+
+    assert header.startswith(b'\xa2\x65roots\x81\xd8\x2a\x58\x25\x00')
+    assert header.endswith(b'\x67version\x01')
+
+    root, blocks = header[13:13 + 36], {}
+
+    while pos < len(data):
+        size, pos = read_varint(data, pos)
+        cid, block = data[pos:pos + 36], data[pos + 36:pos + size]
+        pos += size
+
+        assert cid[:2] in (b'\x01\x55', b'\x01\x70')
+        assert cid[2:4] == b'\x12\x20'
+        assert cid[4:] == hashlib.sha256(block).digest()
+        assert cid not in blocks
+
+        blocks[cid] = block
+
+    return root, blocks
+
+
+@pytest.fixture
+def car(tmp_path):
+    car = CarWriter(tmp_path.joinpath('test.car'))
+    car.open()
+    yield car
+
+    if car._fd:
+        car._fd.close()
+
+
+def add_file(builder: DagBuilder, tmp_path: Path, data: bytes):
+    path = tmp_path.joinpath('file')
+    path.write_bytes(data)
+
+    return builder.add_file(path)
+
+
+@pytest.mark.parametrize('data, raw_leaves, cid', [
+    # Same CIDs as 'ipfs add --cid-version 1' (kubo)
+    (b'', True, 'bafkreihdwdcefgh4dqkjv67uzcmw7ojee6xedzdetojuzjevtenxquvyku'),
+    (b'hello world', True,
+     'bafkreifzjut3te2nhyekklss27nh3k72ysco7y32koao5eei66wof36n5e'),
+    # QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH as a CIDv1
+    (b'', False, 'bafybeif7ztnhq65lumvvtr4ekcwd2ifwgm3awq4zfr3srh462rwyinlb4y')
+])
+def test_file_cid(car, tmp_path, data, raw_leaves, cid):
+    node = add_file(DagBuilder(car, raw_leaves=raw_leaves), tmp_path, data)
+
+    assert cid_str(node.cid) == cid
+    assert node.size == len(data)
+
+
+def test_empty_dir_cid(car, tmp_path):
+    tmp_path.joinpath('empty').mkdir()
+    node = DagBuilder(car).add_dir(tmp_path.joinpath('empty'))
+
+    assert cid_str(node.cid) == \
+        'bafybeiczsscdsbs7ffqz55asqdf3smv6klcw3gofszvwlyarci47bgf354'
+
+
+def test_multi_chunk_file(car, tmp_path):
+    data = bytes(range(256)) * 20
+    node = add_file(DagBuilder(car, chunk_size=1000), tmp_path, data)
+    car.close(node.cid)
+
+    root, blocks = read_car(car.path)
+    fnode = decode_node(blocks[root])
+
+    assert root == node.cid
+    assert fnode['type'] == unixfs.UNIXFS_FILE
+    assert fnode['filesize'] == len(data)
+    assert fnode['blocksizes'] == [1000] * 5 + [120]
+    assert b''.join(blocks[cid] for cid, _, _ in fnode['links']) == data
+    assert node.tsize == len(blocks[root]) + len(data)
+
+
+def test_balanced_layout(car, tmp_path):
+    # One more chunk than the links of a node: the tree gets a level
+    data = bytes(unixfs.MAX_LINKS + 1)
+    node = add_file(DagBuilder(car, chunk_size=1), tmp_path, data)
+    car.close(node.cid)
+
+    _, blocks = read_car(car.path)
+    fnode = decode_node(blocks[node.cid])
+    first, last = [decode_node(blocks[cid])
+                   for cid, _, _ in fnode['links']]
+
+    assert fnode['blocksizes'] == [unixfs.MAX_LINKS, 1]
+    assert len(first['links']) == unixfs.MAX_LINKS
+    assert last['blocksizes'] == [1]
+
+
+@pytest.mark.parametrize('data, hash64', [
+    # Test vectors of the murmur3 x64 128-bit hash (first 64 bits)
+    (b'', '0000000000000000'),
+    (b'hello', 'cbd8a7b341bd9b02'),
+    (b'hello, world', '342fac623a5ebc8e')
+])
+def test_murmur3(data, hash64):
+    assert murmur3_64(data).hex() == hash64
+
+
+def test_hamt_directory(car, tmp_path, monkeypatch):
+    monkeypatch.setattr(unixfs, 'HAMT_SHARDING_SIZE', 4096)
+
+    dirp = tmp_path.joinpath('dir')
+    dirp.mkdir()
+    names = [f'thread-{idx:04}.html' for idx in range(300)]
+
+    for name in names:
+        dirp.joinpath(name).write_text(name)
+
+    node = DagBuilder(car).add_dir(dirp)
+    car.close(node.cid)
+
+    _, blocks = read_car(car.path)
+    found = {}
+
+    def walk(cid: bytes, depth: int) -> None:
+        shard = decode_node(blocks[cid])
+
+        assert shard['type'] == unixfs.UNIXFS_HAMT_SHARD
+        assert shard['fanout'] == 256
+        assert shard['hash_type'] == 0x22
+        assert int.from_bytes(shard['data'], 'big') == sum(
+            1 << int(name[:2], 16) for _, name, _ in shard['links'])
+
+        for lcid, name, _ in shard['links']:
+            assert name[:2] == name[:2].upper()
+
+            if len(name) == 2:
+                walk(lcid, depth + 1)
+            else:
+                # The entry's slot at this depth is its hash's byte
+                assert int(name[:2], 16) == \
+                    murmur3_64(name[2:].encode())[depth]
+                found[name[2:]] = blocks[lcid]
+
+    walk(node.cid, 0)
+
+    assert found == {name: name.encode() for name in names}
+
+
+def test_car_roundtrip(car, tmp_path):
+    dirp = tmp_path.joinpath('dir')
+    dirp.joinpath('sub').mkdir(parents=True)
+    dirp.joinpath('a.html').write_bytes(b'same')
+    dirp.joinpath('sub', 'b.html').write_bytes(b'same')
+
+    node = DagBuilder(car).add_dir(dirp)
+    car.close(node.cid)
+
+    root, blocks = read_car(car.path)
+    rnode = decode_node(blocks[root])
+
+    assert root == node.cid
+    assert [name for _, name, _ in rnode['links']] == ['a.html', 'sub']
+    # The identical files are stored once
+    assert car.blocks == len(blocks) == 3
+
+
+B58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def b58decode(text: str) -> bytes:
+    n = 0
+
+    for char in text:
+        n = n * 58 + B58.index(char)
+
+    return n.to_bytes(34, 'big')
+
+
+def pseudo_random(size: int, seed: str) -> bytes:
+    return hashlib.shake_256(seed.encode()).digest(size)
+
+
+def make_tree(path: Path, files: dict) -> Path:
+    """
+    Files (or directories for None) under path
+    """
+    for name, data in files.items():
+        fpath = path.joinpath(name)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+
+        if data is None:
+            fpath.mkdir()
+        else:
+            fpath.write_bytes(data)
+
+    return path
+
+
+@pytest.fixture
+def kubo_v0(car, monkeypatch):
+    """
+    Builder with the CIDv0 of kubo's defaults (no raw leaves): the CIDs
+    below were given by 'ipfs add' (kubo v0.22)
+    """
+    def make_cid(codec: int, data: bytes) -> bytes:
+        assert codec == unixfs.CODEC_DAG_PB
+        return bytes([unixfs.MH_SHA2_256, 32]) + hashlib.sha256(data).digest()
+
+    monkeypatch.setattr(unixfs, 'make_cid', make_cid)
+
+    return DagBuilder(car, raw_leaves=False)
+
+
+def test_kubo_file(kubo_v0, tmp_path):
+    # Five chunks
+    data = pseudo_random(4 * unixfs.DEFAULT_CHUNK_SIZE + 1000, 'chunks5')
+    node = add_file(kubo_v0, tmp_path, data)
+
+    assert node.cid == \
+        b58decode('QmSzGXSqNV8aukDn6ShmSAqtAQRhNXVFqYYRgWiUGfYcpR')
+
+
+def test_kubo_tree(kubo_v0, tmp_path):
+    dirp = make_tree(tmp_path.joinpath('nested'), {
+        'a.txt': b'hello\n',
+        'sub/b.bin': pseudo_random(300000, 'b'),
+        'sub/c.txt': b'',
+        'sub/empty': None,
+        'sub/deeper/d.txt': b'd' * 1000
+    })
+    node = kubo_v0.add_dir(dirp)
+
+    assert node.cid == \
+        b58decode('QmPjNevB7i7CHh3rWerjwuH4ZahcxnuNXG5VDQBrD4tSPx')
+
+
+@pytest.mark.parametrize('name_size, estimate, cid', [
+    (29, 1023, 'Qme3veHzMSNU6G92QMXrNK8YknGsDjZVhvDDvUDNXN9fB3'),
+    # Sharded from the threshold on
+    (30, 1024, 'QmT4MWMViGzwKhP8vGxn8pVVSFkAPJjVE5geKfR5fCrv44'),
+    (31, 1025, 'QmcC3Pwe3okmmeNG7gxRF9YWmnf67bjXwEaH1kiszumpLv')
+])
+def test_kubo_sharding(kubo_v0, tmp_path, monkeypatch, name_size,
+                       estimate, cid):
+    # Internal.UnixFSShardingSizeThreshold set to 1KiB
+    monkeypatch.setattr(unixfs, 'HAMT_SHARDING_SIZE', 1024)
+
+    files = {f'file-{idx:02}-'.ljust(30, 'x'): pseudo_random(10, f't{idx}')
+             for idx in range(15)}
+    files['last-'.ljust(name_size, 'y')] = pseudo_random(10, 'last')
+    dirp = make_tree(tmp_path.joinpath('dir'), files)
+    # Name and CIDv0 of each link
+    assert sum(len(name) + 34 for name in files) == estimate
+
+    node = kubo_v0.add_dir(dirp)
+
+    assert node.cid == b58decode(cid)
+
+
+def test_kubo_hamt(kubo_v0, tmp_path, monkeypatch):
+    # Shards in shards
+    monkeypatch.setattr(unixfs, 'HAMT_SHARDING_SIZE', 1024)
+
+    dirp = make_tree(tmp_path.joinpath('dir'), {
+        f'thread-{idx:04}.html': pseudo_random(20, f'h{idx}')
+        for idx in range(300)
+    })
+    node = kubo_v0.add_dir(dirp)
+
+    assert node.cid == \
+        b58decode('QmRT4h29ZNpNgYWAV82MVfzfL4YsJR8X62YMv8m8BYTToe')